@@ -0,0 +1,375 @@
+"""
+A local stand-in for the GitHub GraphQL API, serving a synthetic ProjectV2 project.
+
+It understands the queries and mutations sent by src/graphql.py: the project schema, item pages
+(including the items search qualifiers used by the filters), items and issues by node id, issues and
+aliased mutation batches. Mutations are applied to the in-memory items, so repeated runs converge like they do on GitHub.
+
+Run it on its own with:
+
+    python benchmarks/fake_github.py --items 10000 --port 8000
+"""
+import argparse
+import gzip
+import json
+import random
+import re
+import threading
+import time
+from datetime import date, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SIZES = ['X-Large (1-4 weeks)', 'Large (4+ -7 days)', 'Medium (2+ -4 days)', 'Small (1-2 days)', 'Tiny (< 1 day, 1-6 hours)']
+ESTIMATES = ['30 min', '2 hours', '6 hours', '1 day', '2 days', '3 days', '5 days', '1 week', '2 weeks', '3 weeks']
+
+# Item alias -> project field name, as used by the queries of src/graphql.py
+FIELD_NAMES = {'dueDate': 'Due Date', 'release': 'Release', 'week': 'Week', 'estimate': 'Estimate', 'size': 'Size'}
+
+
+def generate_project(items, iterations=200, releases=100, seed=1):
+    """
+    Generates a project with weekly iterations and two week releases around today.
+
+    About 70% of the items are closed issues and 10% are pull requests or drafts. Most open issues
+    have a due date and/or an estimate, and none has its Week, Release or Size set yet.
+    """
+    rng = random.Random(seed)
+    monday = date.today() - timedelta(days=date.today().weekday())
+
+    weeks = [
+        {'id': f"ITER_{index}", 'title': f"Week {index}",
+         'startDate': (monday + timedelta(weeks=index - iterations // 2)).isoformat(), 'duration': 7}
+        for index in range(iterations)
+    ]
+    release_options = []
+    for index in range(releases):
+        start = monday + timedelta(weeks=2 * (index - releases // 2))
+        end = start + timedelta(days=13)
+        release_options.append({
+            'id': f"REL_{index}",
+            'name': f"{start.strftime('%b')} {start.day} - {end.strftime('%b')} {end.day} (v1.{index})"
+        })
+
+    fields = [
+        {'id': 'FIELD_RELEASE', 'name': 'Release', 'options': release_options},
+        {'id': 'FIELD_WEEK', 'name': 'Week', 'configuration': {
+            'iterations': [week for week in weeks if week['startDate'] >= monday.isoformat()],
+            'completedIterations': [week for week in weeks if week['startDate'] < monday.isoformat()],
+        }},
+        {'id': 'FIELD_SIZE', 'name': 'Size', 'options': [{'id': f"SIZE_{i}", 'name': name} for i, name in enumerate(SIZES)]},
+        {'id': 'FIELD_ESTIMATE', 'name': 'Estimate',
+         'options': [{'id': f"EST_{i}", 'name': name} for i, name in enumerate(ESTIMATES)]},
+        # Text and number fields come back as empty nodes
+        {},
+    ]
+    estimates = fields[3]['options']
+
+    nodes = []
+    for index in range(items):
+        kind = rng.random()
+        if kind < 0.1:
+            content = {}
+        else:
+            content = {
+                'id': f"ISSUE_{index}", 'title': f"Issue {index}", 'number': index + 1,
+                'state': 'CLOSED' if kind < 0.8 else 'OPEN',
+                'url': f"https://github.com/bench/repo/issues/{index + 1}",
+            }
+        due_date = monday + timedelta(days=rng.randint(-iterations * 3, iterations * 3))
+        nodes.append({
+            'id': f"ITEM_{index}",
+            'updatedAt': '2024-01-01T00:00:00Z',
+            'content': content,
+            'dueDate': {'date': due_date.isoformat()} if rng.random() < 0.6 else None,
+            'estimate': dict(rng.choice(estimates)) if rng.random() < 0.5 else None,
+            'release': None,
+            'week': None,
+            'size': None,
+        })
+
+    return {'id': 'PROJECT_BENCH', 'updatedAt': '2024-01-01T00:00:00Z', 'fields': {'nodes': fields}}, nodes
+
+
+class FakeGitHub:
+    """
+    State and statistics of the fake API.
+
+    :param latency: Seconds added to every response.
+    :param page_size: Maximum number of items per page, whatever the query asks for.
+    :param rate_limit: Requests per second allowed before answering with a secondary rate limit error.
+    :param timeout_above: Item pages asking for more items than this fail like a GitHub query timeout.
+    :param points: The rate limit points of every token, each token has its own budget. Requests of a
+                   token without points left are rejected with a RATE_LIMITED error.
+    """
+
+    def __init__(self, project, items, latency=0.0, page_size=100, rate_limit=None, points=5000, timeout_above=None):
+        self.project = project
+        self.items = items
+        self.items_by_id = {item['id']: item for item in items}
+        self.items_by_content = {}
+        for item in items:
+            if item['content']:
+                self.items_by_content.setdefault(item['content']['id'], []).append(item)
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limit = rate_limit
+        self.points = points
+        self.timeout_above = timeout_above
+        self.lock = threading.Lock()
+        # The points left of the token of the request being handled by the current thread
+        self.local = threading.local()
+        self.window = (0, 0)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = {
+                'requests': 0, 'operations': {}, 'mutations': 0, 'bytes_in': 0, 'bytes_out': 0, 'rate_limited': 0,
+                'tokens': {},
+                # time.perf_counter() of the first request, for the startup benchmark
+                'first_request_at': None,
+            }
+            # token -> points left
+            self.remaining = {}
+            # Searches are cached for a run, so mutations do not shift the pages being read
+            self.searches = {}
+
+    def throttled(self):
+        if not self.rate_limit:
+            return False
+        with self.lock:
+            second = int(time.time())
+            start, count = self.window
+            if start != second:
+                start, count = second, 0
+            self.window = (start, count + 1)
+            if count + 1 > self.rate_limit:
+                self.stats['rate_limited'] += 1
+                return True
+        return False
+
+    def handle(self, body, token='anonymous'):
+        query = body['query']
+        variables = body.get('variables') or {}
+        match = re.search(r'\b(query|mutation)\s+(\w+)', query)
+        operation = match.group(2) if match else 'anonymous'
+
+        with self.lock:
+            self.stats['requests'] += 1
+            if self.stats['first_request_at'] is None:
+                self.stats['first_request_at'] = time.perf_counter()
+            self.stats['operations'][operation] = self.stats['operations'].get(operation, 0) + 1
+            self.stats['tokens'][token] = self.stats['tokens'].get(token, 0) + 1
+            remaining = self.remaining.get(token, self.points)
+            exhausted = remaining == 0
+            self.remaining[token] = self.local.remaining = max(0, remaining - 1)
+
+        if exhausted:
+            with self.lock:
+                self.stats['rate_limited'] += 1
+            return {'errors': [{'type': 'RATE_LIMITED', 'message': 'API rate limit exceeded'}]}
+
+        if query.lstrip().startswith('mutation'):
+            return self.mutate(query, variables)
+        if 'items(' in query:
+            return self.items_page(query, variables)
+        if 'repository(' in query:
+            issue = {'id': 'ISSUE_COMMENTS', 'number': variables.get('issueNumber')}
+            return {'data': {'repository': {'issue': issue}, 'rateLimit': self.rate_limit_data(1)}}
+        if 'nodes(ids:' in query:
+            return self.nodes(query, variables.get('ids', []))
+
+        owner_type = 'user' if re.search(r'\buser\(', query) else 'organization'
+        return {'data': {owner_type: {'projectV2': self.project}, 'rateLimit': self.rate_limit_data(1)}}
+
+    def rate_limit_data(self, cost):
+        return {'cost': cost, 'remaining': self.local.remaining, 'resetAt': '2099-01-01T00:00:00Z'}
+
+    def search(self, search):
+        """
+        Applies the items search qualifiers used by the filters of src/graphql.py.
+        """
+        if search not in self.searches:
+            predicates = []
+            for negate, qualifier, value in re.findall(r'(-?)(\w+):("[^"]*"|\S+)', search or ''):
+                value = value.strip('"')
+                if qualifier == 'is' and value == 'open':
+                    predicate = lambda item: item['content'].get('state') == 'OPEN'
+                elif qualifier == 'is' and value == 'issue':
+                    predicate = lambda item: bool(item['content'])
+                elif qualifier == 'has':
+                    alias = next(alias for alias, name in FIELD_NAMES.items() if name.lower() == value.lower())
+                    predicate = lambda item, alias=alias: bool(item.get(alias))
+                elif qualifier == 'updated':
+                    since = value.lstrip('>=')
+                    predicate = lambda item, since=since: item['updatedAt'][:10] >= since
+                else:
+                    continue
+                predicates.append((predicate, negate == '-'))
+
+            self.searches[search] = [
+                item for item in self.items
+                if all(predicate(item) != negate for predicate, negate in predicates)
+            ]
+
+        return self.searches[search]
+
+    def items_page(self, query, variables):
+        match = re.search(r'items\(first:\s*(\$?\w+)', query)
+        first = match.group(1) if match else '100'
+        first = int(variables.get(first[1:], 100)) if first.startswith('$') else int(first)
+        if self.timeout_above and first > self.timeout_above:
+            return {'data': None, 'errors': [{
+                'message': 'Something went wrong while executing your query. This may be the result of a timeout, '
+                           'or it could be a GitHub bug.'
+            }]}
+        first = min(first, self.page_size)
+
+        items = self.search(variables.get('search'))
+        start = int(variables.get('after') or 0)
+        page = items[start:start + first]
+        end = start + len(page)
+
+        # Only return what the query selects
+        aliases = [alias for alias in FIELD_NAMES if re.search(rf'\b{alias}:\s*fieldValueByName', query)]
+        content_match = re.search(r'content\s*\{\s*\.\.\.\s*on Issue\s*\{([^}]*)\}', query)
+        content_fields = content_match.group(1).split() if content_match else []
+        nodes = []
+        for item in page:
+            node = {'id': item['id']}
+            if 'updatedAt' in query:
+                node['updatedAt'] = item['updatedAt']
+            for alias in aliases:
+                node[alias] = item[alias]
+            if content_fields:
+                node['content'] = {key: item['content'][key] for key in content_fields if key in item['content']}
+            nodes.append(node)
+
+        owner_type = 'user' if re.search(r'\buser\(', query) else 'organization'
+        return {'data': {
+            owner_type: {'projectV2': {'id': self.project['id'], 'items': {
+                'nodes': nodes,
+                'pageInfo': {'endCursor': str(end), 'hasNextPage': end < len(items)},
+                'totalCount': len(items),
+            }}},
+            'rateLimit': self.rate_limit_data(1),
+        }}
+
+    def nodes(self, query, ids):
+        """
+        Resolves project items by id, or the project items of issues when the query asks for them.
+        """
+        nodes = []
+        for node_id in ids:
+            if 'projectItems' in query:
+                items = self.items_by_content.get(node_id)
+                node = {'projectItems': {'nodes': [dict(item, project={'id': self.project['id']}) for item in items]}} if items else None
+            else:
+                item = self.items_by_id.get(node_id)
+                node = dict(item, project={'id': self.project['id']}) if item else None
+            nodes.append(node)
+
+        return {'data': {'nodes': nodes, 'rateLimit': self.rate_limit_data(1)}}
+
+    def mutate(self, query, variables):
+        data = {}
+        errors = []
+        fields = {field['id']: field for field in self.project['fields']['nodes'] if field}
+        for alias, field, variable in re.findall(r'(\w+):\s*(\w+)\(input:\s*\$(\w+)\)', query):
+            input_value = variables.get(variable, {})
+            with self.lock:
+                self.stats['mutations'] += 1
+            if field == 'updateProjectV2ItemFieldValue':
+                item = self.items_by_id.get(input_value.get('itemId'))
+                project_field = fields.get(input_value.get('fieldId'))
+                if not item or not project_field:
+                    errors.append({'path': [alias], 'message': 'Could not resolve to a node', 'type': 'NOT_FOUND'})
+                    data[alias] = None
+                    continue
+                value = input_value['value']
+                alias_name = next(key for key, name in FIELD_NAMES.items() if name == project_field['name'])
+                item[alias_name] = {'id': value.get('iterationId') or value.get('singleSelectOptionId')}
+                item['updatedAt'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+                data[alias] = {'projectV2Item': {'id': item['id']}}
+            else:
+                data[alias] = {'clientMutationId': None}
+
+        response = {'data': data}
+        if errors:
+            response['errors'] = errors
+        return response
+
+
+def make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # Send headers and body in one segment, otherwise delayed ACKs add 40ms to every request
+        wbufsize = -1
+        disable_nagle_algorithm = True
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if fake.latency:
+                time.sleep(fake.latency)
+
+            if fake.throttled():
+                payload = json.dumps({'message': 'You have exceeded a secondary rate limit.'}).encode()
+                self.respond(403, payload, {'Retry-After': '1'})
+                return
+
+            token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+            payload = json.dumps(fake.handle(json.loads(raw), token)).encode()
+            headers = {
+                'X-RateLimit-Limit': str(fake.points),
+                'X-RateLimit-Remaining': str(fake.local.remaining),
+                'X-RateLimit-Reset': str(int(time.time()) + 3600),
+            }
+            with fake.lock:
+                fake.stats['bytes_in'] += len(raw)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                payload = gzip.compress(payload, compresslevel=1)
+                headers['Content-Encoding'] = 'gzip'
+            self.respond(200, payload, headers)
+
+        def respond(self, status, payload, headers):
+            with fake.lock:
+                fake.stats['bytes_out'] += len(payload)
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+def serve(fake, port=0):
+    """
+    Starts the fake API in a background thread.
+
+    :return: The server, its URL is http://127.0.0.1:{server.server_port}/graphql
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), make_handler(fake))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--rate-limit', type=int, help='requests per second before answering 403')
+    args = parser.parse_args()
+
+    project, items = generate_project(args.items)
+    server = serve(FakeGitHub(project, items, args.latency, args.page_size, args.rate_limit), args.port)
+    print(f"Serving {args.items} items on http://127.0.0.1:{server.server_port}/graphql")
+    threading.Event().wait()
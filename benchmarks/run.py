@@ -0,0 +1,149 @@
+"""
+Offline benchmark of main.main against the fake GitHub API of fake_github.py.
+
+For every project size a synthetic project is served locally and main.main runs against it in a
+fresh Python process, configured through the same environment variables as the action. The run
+reports wall time, requests, bytes, items per second and peak memory:
+
+    python benchmarks/run.py --items 1000 10000 100000 --latency 0.05
+
+Extra action inputs can be passed as --input name=value, e.g. --input concurrency=4.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import fake_github
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def child_env(url, inputs):
+    env = dict(os.environ)
+    env.update({
+        'GITHUB_REPOSITORY_OWNER': 'bench',
+        'GITHUB_SERVER_URL': 'https://github.com',
+        'GITHUB_GRAPHQL_URL': url,
+        'INPUT_GH_TOKEN': 'bench',
+        'INPUT_PROJECT_NUMBER': '1',
+        'INPUT_REPOSITORY_OWNER_TYPE': 'organization',
+        'INPUT_COMMENTS_ISSUE_NUMBER': 'False',
+        'INPUT_COMMENTS_ISSUE_REPO': 'False',
+        # Comment pacing would dominate the run, measure the code instead
+        'INPUT_CONTENT_CREATION_INTERVAL': '0',
+        'PYTHONPATH': os.path.join(ROOT, 'src'),
+    })
+    for name, value in inputs.items():
+        env[f"INPUT_{name.upper()}"] = value
+
+    return env
+
+
+def reset_peak_memory():
+    """
+    Resets the peak resident set size of this process, where the kernel supports it.
+
+    ru_maxrss survives fork and exec on Linux, so a child starts with the peak of the benchmark
+    process, which holds the whole fake project.
+
+    :return: Whether the peak has been reset, and peak_memory then reads it from /proc.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_memory(reset):
+    if reset:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+
+    # ru_maxrss is in kilobytes on Linux, where it may include the peak of the parent process
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_child():
+    """
+    Runs main.main in this process and prints its wall time and peak memory as JSON.
+    """
+    reset = reset_peak_memory()
+    import logging
+    logging.disable(logging.INFO)
+
+    started = time.perf_counter()
+    import main
+    main.main()
+    wall = time.perf_counter() - started
+
+    print(json.dumps({'wall': wall, 'peak_memory': peak_memory(reset)}))
+
+
+def run(fake, url, inputs):
+    fake.reset_stats()
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--child'],
+        env=child_env(url, inputs), capture_output=True, text=True, check=True
+    ).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result.update(fake.stats)
+    result['items'] = len(fake.items)
+    result['items_per_second'] = len(fake.items) / result['wall']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--items', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every response')
+    parser.add_argument('--page-size', type=int, default=100, help='maximum items per page served')
+    parser.add_argument('--rate-limit', type=int, help='requests per second before answering 403')
+    parser.add_argument('--timeout-above', type=int, help='item pages larger than this fail like a query timeout')
+    parser.add_argument('--points', type=int, default=10 ** 7, help='rate limit points of the token')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--releases', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=1, help='runs per size, later runs see the applied updates')
+    parser.add_argument('--input', action='append', default=[], metavar='NAME=VALUE', help='extra action input')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child()
+        return
+
+    inputs = dict(value.split('=', 1) for value in args.input)
+    results = []
+    print(f"{'items':>8} {'run':>4} {'wall s':>8} {'requests':>9} {'mutations':>10} {'MB in':>7} {'MB out':>7} "
+          f"{'items/s':>9} {'peak MB':>8}")
+    for size in args.items:
+        project, items = fake_github.generate_project(size, args.iterations, args.releases)
+        fake = fake_github.FakeGitHub(
+            project, items, args.latency, args.page_size, args.rate_limit, args.points, args.timeout_above
+        )
+        server = fake_github.serve(fake)
+        url = f"http://127.0.0.1:{server.server_port}/graphql"
+        for repeat in range(args.repeat):
+            result = run(fake, url, inputs)
+            result['run'] = repeat + 1
+            results.append(result)
+            print(f"{size:>8} {repeat + 1:>4} {result['wall']:>8.2f} {result['requests']:>9} {result['mutations']:>10} "
+                  f"{result['bytes_in'] / 1e6:>7.2f} {result['bytes_out'] / 1e6:>7.2f} "
+                  f"{result['items_per_second']:>9.0f} {result['peak_memory'] / 1e6:>8.1f}")
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""
+Cold-start benchmark of the action against the fake GitHub API of fake_github.py.
+
+Every run starts src/main.py in a fresh Python process, the way the container does, and measures
+the time from the process start to the first API request, as seen by the fake server, and to the
+process exit. A tiny project keeps the time spent on the items out of the measure:
+
+    python benchmarks/startup.py --runs 10
+
+The runs are repeated on a copy of the sources compiled beforehand, as in the image, and on fresh
+copies without bytecode, compiled on import, and the start of a bare interpreter is measured for
+reference. Extra action
+inputs can be passed as --input name=value.
+"""
+import argparse
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_github
+from run import ROOT, child_env
+
+
+def measure(fake, command, env):
+    """
+    Runs a command once.
+
+    :return: The seconds until the first request, None when there is none, and until the exit.
+    """
+    fake.reset_stats()
+    started = time.perf_counter()
+    subprocess.run(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    ended = time.perf_counter()
+
+    first_request_at = fake.stats['first_request_at']
+    return (first_request_at - started if first_request_at else None), ended - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help='runs per case, the median is reported')
+    parser.add_argument('--items', type=int, default=10)
+    parser.add_argument('--input', action='append', default=[], metavar='NAME=VALUE', help='extra action input')
+    args = parser.parse_args()
+
+    project, items = fake_github.generate_project(args.items, 20, 10)
+    fake = fake_github.FakeGitHub(project, items, points=10 ** 7)
+    server = fake_github.serve(fake)
+    env = child_env(f"http://127.0.0.1:{server.server_port}/graphql", dict(value.split('=', 1) for value in args.input))
+    # As in the container, where the bytecode is written on import when it is missing
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    with tempfile.TemporaryDirectory() as directory:
+        def copy_sources(name):
+            # A copy of the sources without their bytecode, the dependencies keep theirs, as pip writes it
+            sources = os.path.join(directory, name)
+            shutil.copytree(os.path.join(ROOT, 'src'), sources, ignore=shutil.ignore_patterns('__pycache__'))
+            return [sys.executable, os.path.join(sources, 'main.py')], dict(env, PYTHONPATH=sources)
+
+        compiled_command, compiled_env = copy_sources('compiled')
+        subprocess.run([sys.executable, '-m', 'compileall', '-q', compiled_env['PYTHONPATH']], check=True)
+        runs = iter(range(args.runs))
+
+        cases = [
+            ('interpreter', lambda: ([sys.executable, '-c', 'pass'], env)),
+            ('compiled', lambda: (compiled_command, compiled_env)),
+            # A new copy per run, compiled on import
+            ('not compiled', lambda: copy_sources(f"run-{next(runs)}")),
+        ]
+
+        print(f"{'case':>14} {'first request s':>16} {'exit s':>8}")
+        for name, case in cases:
+            results = [measure(fake, *case()) for _ in range(args.runs)]
+            first_requests = [first_request for first_request, _ in results if first_request is not None]
+            first_request = f"{statistics.median(first_requests):.3f}" if first_requests else '-'
+            print(f"{name:>14} {first_request:>16} {statistics.median(exit for _, exit in results):>8.3f}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+import threading
+
+import graphql
+import journal as progress_journal
+from logger import logger
+
+
+class MutationBatcher:
+    """
+    Collects field updates and comments and sends them as aliased multi-operation mutations.
+
+    Field updates are always sent before the comments that describe them, and the comments of
+    an item are dropped if any of its field updates failed. Errors are tracked per item, so one
+    bad item does not fail the rest of its batch.
+
+    With an executor, batches are sent in the background and at most max_in_flight of them are
+    queued or running at the same time.
+
+    With a journal.Journal, every applied mutation is recorded in it, and mutations it already
+    holds are not sent again.
+    """
+
+    def __init__(self, project_id, batch_size, executor=None, max_in_flight=None, journal=None):
+        self.project_id = project_id
+        self.batch_size = max(1, batch_size)
+        self.executor = executor
+        self.pending_updates = []
+        self.pending_comments = []
+        self.futures = []
+        self.lock = threading.Lock()
+        self.in_flight = threading.BoundedSemaphore(max_in_flight or 1)
+        self.journal = journal
+        # item id -> list of GraphQL errors
+        self.failed = {}
+        self.comments_sent = 0
+
+    def add_field_updates(self, item_id, updates):
+        for update in updates:
+            key = progress_journal.update_key(item_id, update)
+            if self.journal and self.journal.is_applied(key):
+                continue
+            input_value = graphql.field_update_input(self.project_id, item_id, update)
+            if input_value is not None:
+                self.pending_updates.append((item_id, ('update_field', input_value), key))
+
+        if len(self.pending_updates) >= self.batch_size:
+            self.flush_updates()
+
+    def add_comment(self, item_id, subject_id, comment):
+        key = progress_journal.comment_key(item_id, subject_id, comment)
+        if self.journal and self.journal.is_applied(key):
+            return
+        self.pending_comments.append((item_id, ('comment', graphql.comment_input(subject_id, comment)), key))
+
+        if len(self.pending_comments) >= self.batch_size:
+            self.flush()
+
+    def flush_updates(self):
+        while self.pending_updates:
+            batch = self.pending_updates[:self.batch_size]
+            self.pending_updates = self.pending_updates[self.batch_size:]
+            self._submit(batch)
+
+    def flush(self):
+        # Comments may only go out once the updates they describe have been applied
+        self.flush_updates()
+        self.wait()
+
+        comments = [comment for comment in self.pending_comments if comment[0] not in self.failed]
+        self.pending_comments = []
+        while comments:
+            batch = comments[:self.batch_size]
+            comments = comments[self.batch_size:]
+            self._submit(batch)
+
+    def wait(self):
+        """
+        Waits for every batch sent in the background to complete.
+        """
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.wait()
+
+    def _submit(self, batch):
+        if self.executor is None:
+            self._send(batch)
+            return
+
+        self.in_flight.acquire()
+        future = self.executor.submit(self._send, batch)
+        future.add_done_callback(lambda _: self.in_flight.release())
+        self.futures.append(future)
+
+    def _send(self, batch):
+        failed = graphql.run_batched_mutation([operation for _, operation, _ in batch])
+        for index, errors in failed.items():
+            item_id = batch[index][0]
+            with self.lock:
+                self.failed.setdefault(item_id, []).extend(errors)
+            logger.info(f"Mutation failed for item {item_id}: {errors}")
+
+        applied = [entry for index, entry in enumerate(batch) if index not in failed]
+        if self.journal:
+            self.journal.record_applied([key for _, _, key in applied])
+
+        comments = sum(1 for _, operation, _ in applied if operation[0] == 'comment')
+        with self.lock:
+            self.comments_sent += comments
@@ -1,4 +1,6 @@
+import json
 import os
+import re
 
 repository_owner = os.environ['GITHUB_REPOSITORY_OWNER']
 repository_owner_type = os.environ['INPUT_REPOSITORY_OWNER_TYPE']
@@ -8,8 +10,133 @@ is_enterprise = True if os.environ.get('INPUT_ENTERPRISE_GITHUB') == 'True' else
 dry_run = True if os.environ.get('INPUT_DRY_RUN') == 'True' else False
 
 gh_token = os.environ['INPUT_GH_TOKEN']
-project_number = int(os.environ['INPUT_PROJECT_NUMBER'])
+
+
+def parse_projects(value, default_owner):
+    """
+    Parses a list of projects such as "1, 2, other-org/3" into (owner, project number) tuples.
+
+    A project listed more than once, such as "1, owner/1" when owner is the default owner, is kept
+    once, so that its items are not processed and commented on twice. Owners are compared ignoring
+    case, like GitHub does.
+    """
+    projects = []
+    seen = set()
+    for entry in value.replace(',', ' ').split():
+        owner, _, number = entry.rpartition('/')
+        project = (owner or default_owner, int(number))
+        if (project[0].lower(), project[1]) not in seen:
+            seen.add((project[0].lower(), project[1]))
+            projects.append(project)
+
+    return projects
+
+
+# One or more projects, either a number of a project of the repository owner or owner/number. Every
+# owner has the same type, repository_owner_type, the projects of an organization and of a user
+# cannot be processed by the same run.
+projects = parse_projects(os.environ['INPUT_PROJECT_NUMBER'], repository_owner)
+project_number = projects[0][1]
 api_endpoint = os.environ['GITHUB_GRAPHQL_URL']
 
 comments_issue_number = 0 if os.environ.get('INPUT_COMMENTS_ISSUE_NUMBER') == 'False' else int(os.environ.get('INPUT_COMMENTS_ISSUE_NUMBER'))
 comments_issue_repo = False if os.environ.get('INPUT_COMMENTS_ISSUE_REPO') == 'False' else os.environ.get('INPUT_COMMENTS_ISSUE_REPO')
+
+# Number of mutations packed into a single aliased GraphQL document
+mutation_batch_size = int(os.environ.get('INPUT_MUTATION_BATCH_SIZE') or 25)
+
+# HTTP transport settings
+http_pool_size = int(os.environ.get('INPUT_HTTP_POOL_SIZE') or 10)
+http_connect_timeout = float(os.environ.get('INPUT_HTTP_CONNECT_TIMEOUT') or 10)
+http_read_timeout = float(os.environ.get('INPUT_HTTP_READ_TIMEOUT') or 60)
+http_max_retries = int(os.environ.get('INPUT_HTTP_MAX_RETRIES') or 5)
+http_backoff = float(os.environ.get('INPUT_HTTP_BACKOFF') or 1)
+http_backoff_max = float(os.environ.get('INPUT_HTTP_BACKOFF_MAX') or 60)
+
+# Number of mutation batches sent concurrently
+concurrency = max(1, int(os.environ.get('INPUT_CONCURRENCY') or 1))
+# Requests wait for the rate limit reset once the remaining points drop to this value
+rate_limit_min_remaining = int(os.environ.get('INPUT_RATE_LIMIT_MIN_REMAINING') or 50)
+# Seconds reserved per created comment, to stay under the secondary rate limits
+content_creation_interval = float(os.environ.get('INPUT_CONTENT_CREATION_INTERVAL') or 1)
+
+# Filter project items through the ProjectV2 items search instead of downloading all of them
+server_side_filters = False if os.environ.get('INPUT_SERVER_SIDE_FILTERS') == 'False' else True
+
+# Directory for caches kept between runs, caching is disabled when not set
+cache_dir = False if os.environ.get('INPUT_CACHE_DIR', 'False') == 'False' else os.environ.get('INPUT_CACHE_DIR')
+# Maximum age in seconds of a cached project schema
+schema_cache_ttl = float(os.environ.get('INPUT_SCHEMA_CACHE_TTL') or 6 * 60 * 60)
+
+# Only process the items changed since the last successful run, the state is kept in cache_dir
+incremental = True if os.environ.get('INPUT_INCREMENTAL') == 'True' and cache_dir else False
+# Seconds after which an incremental run does a full sync of all items again
+full_resync_interval = float(os.environ.get('INPUT_FULL_RESYNC_INTERVAL') or 24 * 60 * 60)
+
+# Post the summaries of all updated items as a few digest comments on the comments issue
+comments_digest = True if os.environ.get('INPUT_COMMENTS_DIGEST') == 'True' else False
+
+# Number of projects processed concurrently
+project_concurrency = max(1, int(os.environ.get('INPUT_PROJECT_CONCURRENCY') or 4))
+
+# Metrics reports, each one is written only when set
+metrics_json = False if os.environ.get('INPUT_METRICS_JSON', 'False') == 'False' else os.environ.get('INPUT_METRICS_JSON')
+metrics_prometheus = False if os.environ.get('INPUT_METRICS_PROMETHEUS', 'False') == 'False' else os.environ.get('INPUT_METRICS_PROMETHEUS')
+step_summary = os.environ.get('GITHUB_STEP_SUMMARY')
+
+# Seconds after which the run stops starting new work, 0 for no deadline
+deadline = float(os.environ.get('INPUT_DEADLINE') or 0)
+
+# Keep a progress journal in cache_dir, so an interrupted run is resumed by the next one
+resumable = True if os.environ.get('INPUT_RESUMABLE') == 'True' and cache_dir else False
+
+# Inputs that are set but have no effect, since the state they keep needs cache_dir
+ignored_without_cache_dir = [
+    name for name in ('incremental', 'resumable')
+    if os.environ.get(f"INPUT_{name.upper()}") == 'True' and not cache_dir
+]
+
+# Process only the items of the triggering projects_v2_item or issues event instead of every item
+event_mode = False if os.environ.get('INPUT_EVENT_MODE') == 'False' else True
+event_name = os.environ.get('GITHUB_EVENT_NAME')
+event_path = os.environ.get('GITHUB_EVENT_PATH')
+
+# Run as a resident service, processing the projects whenever a trigger arrives on daemon_listen
+daemon = True if os.environ.get('INPUT_DAEMON') == 'True' else False
+# Address of the trigger endpoint, host:port or unix:/path/of/the/socket
+daemon_listen = os.environ.get('INPUT_DAEMON_LISTEN') or '127.0.0.1:8080'
+# Seconds without a new trigger before a pass starts, a burst of triggers results in a single pass
+daemon_debounce = float(os.environ.get('INPUT_DAEMON_DEBOUNCE') or 2)
+# Seconds between the scheduled passes over every item, 0 to only run on triggers
+daemon_interval = float(os.environ.get('INPUT_DAEMON_INTERVAL') or 0)
+
+# Write the mutations of the run to this plan file instead of sending them
+plan_file = False if os.environ.get('INPUT_PLAN_FILE', 'False') == 'False' else os.environ.get('INPUT_PLAN_FILE')
+# Send the mutations of this plan file instead of evaluating the rules
+apply_plan = False if os.environ.get('INPUT_APPLY_PLAN', 'False') == 'False' else os.environ.get('INPUT_APPLY_PLAN')
+
+# Split the items of every project between shard_count jobs, this job processes shard_index (0 based)
+shard_count = max(1, int(os.environ.get('INPUT_SHARD_COUNT') or 1))
+shard_index = int(os.environ.get('INPUT_SHARD_INDEX') or 0)
+if not 0 <= shard_index < shard_count:
+    raise ValueError(f"shard_index must be between 0 and {shard_count - 1}, not {shard_index}")
+# Glob of the metrics_json files of the shards, combined into this run's reports instead of processing
+merge_metrics = False if os.environ.get('INPUT_MERGE_METRICS', 'False') == 'False' else os.environ.get('INPUT_MERGE_METRICS')
+
+# Items per page: the initial and largest page size, and the smallest one failing pages shrink to
+page_size = int(os.environ.get('INPUT_PAGE_SIZE') or 100)
+page_size_min = int(os.environ.get('INPUT_PAGE_SIZE_MIN') or 10)
+# Response time in seconds the item pages are sized for
+page_target_seconds = float(os.environ.get('INPUT_PAGE_TARGET_SECONDS') or 5)
+
+# More tokens, separated by commas or new lines, every request goes to the one with the most points left
+gh_tokens = [token for token in re.split(r'[\s,]+', os.environ.get('INPUT_GH_TOKENS') or '') if token]
+# GitHub App installations used like tokens, a JSON list of {"app_id", "installation_id", "private_key"}
+github_apps = json.loads(os.environ.get('INPUT_GITHUB_APPS') or '[]')
+# REST API root, where the installation tokens of the GitHub Apps are created
+api_url = os.environ.get('GITHUB_API_URL') or 'https://api.github.com'
+
+# Write the schema and the items of the projects to this snapshot file instead of processing them
+snapshot_export = False if os.environ.get('INPUT_SNAPSHOT_EXPORT', 'False') == 'False' else os.environ.get('INPUT_SNAPSHOT_EXPORT')
+# Evaluate the rules over this snapshot file without any request, the changes go to plan_file when set
+snapshot_evaluate = False if os.environ.get('INPUT_SNAPSHOT_EVALUATE', 'False') == 'False' else os.environ.get('INPUT_SNAPSHOT_EVALUATE')
@@ -0,0 +1,127 @@
+import threading
+import time
+from datetime import datetime
+
+import config
+import ratelimit
+from logger import logger
+
+
+class Credential:
+    """
+    A token, with a rate limiter tracking its own budget.
+    """
+
+    def __init__(self, name, token=None):
+        self.name = name
+        self.token = token
+        self.limiter = ratelimit.RateLimiter(
+            min_remaining=config.rate_limit_min_remaining,
+            content_interval=config.content_creation_interval
+        )
+        self.disabled = False
+
+    def authorization(self, session):
+        return f"Bearer {self.token}"
+
+
+class AppCredential(Credential):
+    """
+    A GitHub App installation, authenticating with installation tokens that are renewed before
+    they expire. PyJWT, installed with cryptography for the RS256 signature, is imported on first use.
+    """
+
+    def __init__(self, name, app_id, installation_id, private_key):
+        super().__init__(name)
+        self.app_id = app_id
+        self.installation_id = installation_id
+        self.private_key = private_key
+        self.expires_at = 0
+        self.lock = threading.Lock()
+
+    def authorization(self, session):
+        with self.lock:
+            # Installation tokens last an hour, renew them a few minutes early
+            if self.token is None or time.time() > self.expires_at - 300:
+                self.renew(session)
+            return f"Bearer {self.token}"
+
+    def renew(self, session):
+        import jwt
+
+        now = int(time.time())
+        assertion = jwt.encode({'iat': now - 60, 'exp': now + 540, 'iss': str(self.app_id)}, self.private_key, algorithm='RS256')
+        response = session.post(
+            f"{config.api_url}/app/installations/{self.installation_id}/access_tokens",
+            headers={'Authorization': f"Bearer {assertion}", 'Accept': 'application/vnd.github+json'},
+            timeout=(config.http_connect_timeout, config.http_read_timeout)
+        )
+        response.raise_for_status()
+        data = response.json()
+        self.token = data['token']
+        self.expires_at = datetime.fromisoformat(data['expires_at'].replace('Z', '+00:00')).timestamp()
+        logger.info(f"Renewed the installation token of {self.name}")
+
+
+class CredentialPool:
+    """
+    Spreads the requests over several credentials, each with its own rate limit budget.
+
+    Every request goes to the credential with the most points left, as last reported by the rate
+    limit headers. Credentials that have not been used yet are tried first, so that their budget
+    becomes known. When every credential waits for a reset, the one available first is used, and
+    credentials rejected by GitHub are taken out of the pool.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            enabled = [credential for credential in self.credentials if not credential.disabled]
+        if not enabled:
+            raise RuntimeError('Every GitHub credential has been rejected')
+
+        now = time.time()
+        available = [credential for credential in enabled if credential.limiter.available_at() <= now]
+        if not available:
+            return min(enabled, key=lambda credential: credential.limiter.available_at())
+
+        return max(
+            available,
+            key=lambda credential: float('inf') if credential.limiter.remaining is None else credential.limiter.remaining
+        )
+
+    def disable(self, credential, reason):
+        with self.lock:
+            credential.disabled = True
+            left = sum(1 for other in self.credentials if not other.disabled)
+        logger.info(f"Credential {credential.name} rejected ({reason}), {left} left")
+        return left > 0
+
+    def remaining(self):
+        """
+        Returns the points left over every credential, None until one of them is known.
+        """
+        known = [credential.limiter.remaining for credential in self.credentials if credential.limiter.remaining is not None]
+        return sum(known) if known else None
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            credentials = [Credential('token 1', config.gh_token)]
+            credentials += [Credential(f"token {index + 2}", token) for index, token in enumerate(config.gh_tokens)]
+            credentials += [
+                AppCredential(f"app {app['app_id']}/{app['installation_id']}", app['app_id'], app['installation_id'], app['private_key'])
+                for app in config.github_apps
+            ]
+            _pool = CredentialPool(credentials)
+
+    return _pool
@@ -0,0 +1,164 @@
+import json
+import os
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import config
+import event
+from logger import logger
+from metrics import metrics
+
+
+class Triggers:
+    """
+    Collects the triggers received while waiting for, or running, a pass.
+
+    A trigger either names the items and issues of an event, or asks for a pass over every item.
+    The triggers of a burst are merged into one pass, which starts once no new trigger has arrived
+    for config.daemon_debounce seconds.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = False
+        self.full = False
+        self.item_ids = set()
+        self.issue_ids = set()
+        self.last_trigger = 0
+
+    def add(self, targets):
+        """
+        :param targets: The (item ids, issue ids) of an event, see event.event_targets, or None for a
+                        pass over every item.
+        """
+        with self.condition:
+            if targets is None:
+                self.full = True
+            else:
+                self.item_ids.update(targets[0])
+                self.issue_ids.update(targets[1])
+            self.pending = True
+            self.last_trigger = time.monotonic()
+            self.condition.notify()
+
+    def take(self, timeout=None):
+        """
+        Waits for the next burst of triggers.
+
+        :param timeout: Seconds after which a pass over every item is due even without a trigger.
+        :return: The merged targets of the burst, None for a pass over every item.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending, timeout=timeout):
+                return None
+
+            # Wait for the burst to settle
+            while True:
+                remaining = self.last_trigger + config.daemon_debounce - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.condition.wait(remaining)
+
+            targets = None if self.full else (sorted(self.item_ids), sorted(self.issue_ids))
+            self.pending = False
+            self.full = False
+            self.item_ids = set()
+            self.issue_ids = set()
+            return targets
+
+
+def make_handler(triggers, status):
+    class Handler(BaseHTTPRequestHandler):
+        """
+        POST queues a trigger. A body with a GitHub webhook payload, with its event name in the
+        X-GitHub-Event header, only processes the items of the event. GET /health returns the state
+        of the last pass and GET /metrics the metrics in the Prometheus format.
+        """
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+        def address_string(self):
+            # Unix socket clients have no address
+            return self.client_address[0] if self.client_address else 'unix'
+
+        def do_POST(self):
+            raw = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            try:
+                payload = json.loads(raw) if raw else None
+            except ValueError:
+                self.respond(400, {'error': 'The body is not valid JSON'})
+                return
+
+            targets = event.event_targets(self.headers.get('X-GitHub-Event'), payload)
+            triggers.add(targets)
+            self.respond(202, {'queued': 'all' if targets is None else {'items': targets[0], 'issues': targets[1]}})
+
+        def do_GET(self):
+            if self.path == '/health':
+                self.respond(200, status)
+            elif self.path == '/metrics':
+                self.respond(200, metrics.to_prometheus(), content_type='text/plain; version=0.0.4')
+            else:
+                self.respond(404, {'error': 'Not found'})
+
+        def respond(self, code, body, content_type='application/json'):
+            payload = (body if isinstance(body, str) else json.dumps(body)).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(handler):
+    if config.daemon_listen.startswith('unix:'):
+        path = config.daemon_listen[len('unix:'):]
+        if os.path.exists(path):
+            os.remove(path)
+        return UnixHTTPServer(path, handler)
+
+    host, _, port = config.daemon_listen.rpartition(':')
+    return ThreadingHTTPServer((host or '127.0.0.1', int(port)), handler)
+
+
+def serve(process):
+    """
+    Runs as a resident service: the HTTP pool, the project schemas and their calendar indexes stay
+    warm between passes, so a pass mostly costs its own API calls.
+
+    :param process: Called with the targets of every pass, see Triggers.take.
+    """
+    triggers = Triggers()
+    status = {'passes': 0, 'running': False, 'last_pass': None}
+    server = make_server(make_handler(triggers, status))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Listening for triggers on {config.daemon_listen}")
+
+    # Start with a pass over every item, so nothing changed while the daemon was down is missed
+    triggers.add(None)
+    while True:
+        targets = triggers.take(timeout=config.daemon_interval or None)
+        status['running'] = True
+        started = time.time()
+        try:
+            process(targets)
+            result = 'ok'
+        except Exception as e:
+            # A failed pass must not stop the service, the next trigger tries again
+            logger.exception(f"Pass failed: {e}")
+            result = 'failed'
+        finally:
+            status['running'] = False
+
+        status['passes'] += 1
+        status['last_pass'] = {'started_at': started, 'duration': time.time() - started, 'result': result}
+        metrics.write_reports()
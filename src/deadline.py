@@ -0,0 +1,35 @@
+import time
+
+import config
+
+
+class DeadlineExceeded(Exception):
+    """
+    Raised when waiting, for example for a rate limit reset, would run past the deadline.
+    """
+
+
+# Time by which the run must stop, None without a deadline
+deadline_at = None
+
+
+def start():
+    """
+    Starts the deadline clock, config.deadline seconds from now.
+    """
+    global deadline_at
+    deadline_at = time.time() + config.deadline if config.deadline else None
+
+
+def reached():
+    return deadline_at is not None and time.time() >= deadline_at
+
+
+def check(until):
+    """
+    Raises DeadlineExceeded if the run would still be waiting at the deadline.
+
+    :param until: The time the caller is about to wait for.
+    """
+    if deadline_at is not None and until >= deadline_at:
+        raise DeadlineExceeded(f"Waiting until {time.ctime(until)} would run past the deadline")
@@ -0,0 +1,71 @@
+import json
+
+import config
+import graphql
+from logger import logger
+
+# Event name -> actions after which the item no longer needs its fields set
+IGNORED_ACTIONS = {
+    'projects_v2_item': {'deleted', 'archived'},
+    'issues': {'deleted', 'transferred'},
+}
+
+
+def read_payload():
+    """
+    Reads the payload of the event that triggered the workflow.
+
+    :return: The payload, or None when the event is not about individual items.
+    """
+    if not config.event_mode or config.event_name not in IGNORED_ACTIONS or not config.event_path:
+        return None
+
+    try:
+        with open(config.event_path) as event_file:
+            return json.load(event_file)
+    except (OSError, ValueError) as e:
+        logger.info(f"Could not read the event payload, processing every item: {e}")
+        return None
+
+
+def event_targets(event_name, payload):
+    """
+    Finds the project items and issues an event is about.
+
+    :return: A (item ids, issue ids) tuple, or None when the event is not about individual items and
+             every item has to be processed.
+    """
+    if event_name not in IGNORED_ACTIONS or not payload:
+        return None
+
+    action = payload.get('action')
+    if action in IGNORED_ACTIONS[event_name]:
+        logger.info(f"Nothing to do for a {event_name} {action} event")
+        return [], []
+
+    if event_name == 'projects_v2_item':
+        item_id = (payload.get('projects_v2_item') or {}).get('node_id')
+        return ([item_id], []) if item_id else None
+
+    issue_id = (payload.get('issue') or {}).get('node_id')
+    return ([], [issue_id]) if issue_id else None
+
+
+def fetch_items(item_ids, issue_ids, projection):
+    """
+    Fetches project items by id, and the project items of issues in every project.
+
+    Items of other projects are left to the caller to filter out, by project.id.
+
+    :param projection: The item data to fetch, see graphql.build_items_query.
+    """
+    items = []
+    if item_ids:
+        logger.info(f"Fetching {len(item_ids)} project items by id")
+        items += graphql.get_project_items(list(item_ids), projection)
+    if issue_ids:
+        logger.info(f"Fetching the project items of {len(issue_ids)} issues")
+        items += graphql.get_issue_project_items(list(issue_ids), projection)
+
+    return items
+
@@ -1,185 +1,447 @@
-import requests
+import threading
+import time
+
 import config
+import deadline
+import pagination
+import sharding
+import transport
 from logger import logger
 
 
-def get_project(organization_name, project_number):
+def get_project(organization_name, project_number, owner_type='organization'):
     # GraphQL query
-    query = """
-    query($organization: String!, $projectNumber: Int!) {
-        organization(login: $organization) {
-            projectV2(number: $projectNumber) {
+    query = f"""
+    query GetProject($organization: String!, $projectNumber: Int!) {{
+        {owner_type}(login: $organization) {{
+            projectV2(number: $projectNumber) {{
               id
-              fields(first: 100) {
-                nodes {
-                  ... on ProjectV2SingleSelectField {
+              updatedAt
+              fields(first: 100) {{
+                nodes {{
+                  ... on ProjectV2SingleSelectField {{
                     id
                     name
-                    options {
+                    options {{
                         id
                         name
-                    }
-                  }
-                  ... on ProjectV2IterationField {
+                    }}
+                  }}
+                  ... on ProjectV2IterationField {{
                     id
                     name
-                    configuration {
-                        iterations {
+                    configuration {{
+                        iterations {{
                             id
                             title
                             startDate
                             duration
-                        }
-                        completedIterations {
+                        }}
+                        completedIterations {{
                             id
                             title
                             startDate
                             duration
-                        }
-                    }
-                  }
-                }
-              }
-            }
-        }
-    }
+                        }}
+                    }}
+                  }}
+                }}
+              }}
+            }}
+        }}
+        rateLimit {{
+          cost
+          remaining
+          resetAt
+        }}
+    }}
     """
 
     variables = {
         'organization': organization_name,
         'projectNumber': project_number
     }
-    response = requests.post(
-        config.api_endpoint,
-        json={"query": query, "variables": variables},
-        headers={"Authorization": f"Bearer {config.gh_token}"}
-    )
+    response = transport.execute(query, variables)
+    record_cost('GetProject', response)
 
-    return response.json().get('data').get('organization').get('projectV2')
+    return response.get('data').get(owner_type).get('projectV2')
 
 
-def get_project_issues(owner, owner_type, project_number, filters=None, after=None, issues=None):
+def get_project_stamp(organization_name, project_number, owner_type='organization'):
+    """
+    Fetches only the id and the last update time of a project, to validate a cached schema.
+    """
     query = f"""
-    query GetProjectIssues($owner: String!, $projectNumber: Int!, $after: String)  {{
-          {owner_type}(login: $owner) {{
+    query GetProjectStamp($organization: String!, $projectNumber: Int!) {{
+        {owner_type}(login: $organization) {{
             projectV2(number: $projectNumber) {{
               id
-              title
-              number
-              items(first: 100,after: $after) {{
+              updatedAt
+            }}
+        }}
+        rateLimit {{
+          cost
+          remaining
+          resetAt
+        }}
+    }}
+    """
+
+    variables = {
+        'organization': organization_name,
+        'projectNumber': project_number
+    }
+    response = transport.execute(query, variables)
+    record_cost('GetProjectStamp', response)
+
+    return response.get('data').get(owner_type).get('projectV2')
+
+
+# Item alias in the items query -> (name of the project field, field value type, selection)
+ITEM_FIELDS = {
+    'dueDate': ('Due Date', 'ProjectV2ItemFieldDateValue', 'date'),
+    'release': ('Release', 'ProjectV2ItemFieldSingleSelectValue', 'id: optionId'),
+    'week': ('Week', 'ProjectV2ItemFieldIterationValue', 'id: iterationId'),
+    'estimate': ('Estimate', 'ProjectV2ItemFieldSingleSelectValue', 'id: optionId name'),
+    'size': ('Size', 'ProjectV2ItemFieldSingleSelectValue', 'id: optionId'),
+}
+
+# The item data fetched when the caller does not declare what it reads
+DEFAULT_PROJECTION = {
+    'item': ['updatedAt'],
+    'fields': list(ITEM_FIELDS),
+    'content': ['id', 'title', 'number', 'state', 'url'],
+}
+
+# Operation name -> total rateLimit cost of the queries sent so far
+query_costs = {}
+_query_costs_lock = threading.Lock()
+
+
+def record_cost(operation, response):
+    """
+    Adds the rateLimit cost reported in a query response to query_costs.
+
+    :return: The rateLimit data of the response, or None if it was not requested.
+    """
+    rate_limit = (response.get('data') or {}).get('rateLimit')
+    if rate_limit:
+        with _query_costs_lock:
+            query_costs[operation] = query_costs.get(operation, 0) + rate_limit['cost']
+
+    return rate_limit
+
+
+def item_selections(projection):
+    """
+    Lists the selections of a ProjectV2Item for the item data of the projection, see build_items_query.
+    """
+    selections = ['id'] + list(projection.get('item', []))
+    for alias in projection.get('fields', []):
+        name, value_type, selection = ITEM_FIELDS[alias]
+        selections.append(f'{alias}: fieldValueByName(name: "{name}") {{ ... on {value_type} {{ {selection} }} }}')
+    if projection.get('content'):
+        selections.append(f"content {{ ... on Issue {{ {' '.join(projection['content'])} }} }}")
+
+    return selections
+
+
+def build_items_query(owner_type, projection, search=False):
+    """
+    Builds the items query, selecting only the item data listed in the projection.
+
+    :param projection: A dictionary with:
+                       - item: Scalar fields of the project item, besides its id
+                       - fields: Aliases of the project field values, see ITEM_FIELDS
+                       - content: Fields of the issue
+    :param search: Whether the query takes a $search items query.
+    """
+    selections = item_selections(projection)
+
+    search_definition = ', $search: String!' if search else ''
+    search_argument = ', query: $search' if search else ''
+    nodes = '\n'.join(f"                  {selection}" for selection in selections)
+    return f"""
+    query GetProjectIssues($owner: String!, $projectNumber: Int!, $first: Int!, $after: String{search_definition}) {{
+          {owner_type}(login: $owner) {{
+            projectV2(number: $projectNumber) {{
+              items(first: $first, after: $after{search_argument}) {{
                 nodes {{
-                  id
-                  dueDate: fieldValueByName(name: "Due Date") {{
-                    ... on ProjectV2ItemFieldDateValue {{
-                      id
-                      date
-                    }}
-                  }}
-                  release: fieldValueByName(name: "Release") {{
-                    ... on ProjectV2ItemFieldSingleSelectValue {{
-                      id: optionId
-                      name
-                    }}
-                  }}
-                  week: fieldValueByName(name: "Week") {{
-                    ... on ProjectV2ItemFieldIterationValue {{
-                      id: iterationId
-                      title
-                      startDate
-                      duration
-                    }}
-                  }}
-                  estimate: fieldValueByName(name: "Estimate") {{
-                    ... on ProjectV2ItemFieldSingleSelectValue {{
-                      name
-                      id
-                    }}
-                  }}
-                  size: fieldValueByName(name: "Size") {{
-                    ... on ProjectV2ItemFieldSingleSelectValue {{
-                      id: optionId
-                      name
-                    }}
-                  }}
-                  content {{
-                    ... on Issue {{
-                      id
-                      title
-                      number
-                      state
-                      url
-                      assignees(first:20) {{
-                        nodes {{
-                          name
-                          email
-                          login
-                        }}
-                      }}
-                    }}
-                  }}
+{nodes}
                 }}
                 pageInfo {{
-                endCursor
-                hasNextPage
-                hasPreviousPage
-              }}
-              totalCount
+                  endCursor
+                  hasNextPage
+                }}
               }}
             }}
           }}
+          rateLimit {{
+            cost
+            remaining
+            resetAt
+          }}
         }}
     """
 
-    variables = {
-        'owner': owner,
-        'projectNumber': project_number,
-        'after': after
-    }
 
-    response = requests.post(
-        config.api_endpoint,
-        json={"query": query, "variables": variables},
-        headers={"Authorization": f"Bearer {config.gh_token}"}
-    )
+def search_term(qualifier, value):
+    if ' ' in value:
+        value = f'"{value}"'
+    return f"{qualifier}:{value}"
+
 
-    if response.json().get('errors'):
-        logger.info(response.json().get('errors'))
+def build_item_searches(filters):
+    """
+    Translates the item filters into ProjectV2 item search queries.
 
-    if issues is None:
-        issues = []
+    Project searches combine their qualifiers with AND, so "has any of these fields" is split into
+    disjoint searches: the first field, the second field without the first one, and so on.
 
-    nodes = response.json().get('data').get(owner_type).get('projectV2').get('items').get('nodes')
+    :param filters: The filters dictionary, see matches_filters.
+    :return: A list of search queries, whose results together cover every matching item.
+    """
+    terms = []
+    if filters.get('open_only'):
+        terms += ['is:issue', 'is:open']
+    if filters.get('updated_since'):
+        terms.append(f"updated:>={filters['updated_since']}")
+
+    field_names = [ITEM_FIELDS[alias][0] for alias in filters.get('has_any_field') or []]
+    if not field_names:
+        return [' '.join(terms)]
+
+    return [
+        ' '.join(
+            terms
+            + [search_term('has', name)]
+            + [search_term('-has', previous) for previous in field_names[:index]]
+        )
+        for index, name in enumerate(field_names)
+    ]
 
-    if filters:
-        filtered_issues = []
-        for node in nodes:
-            if filters.get('open_only') and node['content'].get('state') != 'OPEN':
-                continue
 
-            filtered_issues.append(node)
+def matches_filters(node, filters):
+    """
+    Applies the item filters on the client.
 
-        nodes = filtered_issues
+    :param filters: A dictionary with:
+                    - open_only: Only keep open issues
+                    - has_any_field: Only keep items with a value in at least one of these fields (item aliases)
+                    - updated_since: Only keep items updated on or after this date (YYYY-MM-DD)
+                    - shard: Only keep the items of this (shard index, shard count), see sharding.shard_of
+    """
+    if filters.get('open_only') and (node.get('content') or {}).get('state') != 'OPEN':
+        return False
 
-    issues = issues + nodes
+    has_any_field = filters.get('has_any_field')
+    if has_any_field and not any(node.get(alias) for alias in has_any_field):
+        return False
 
-    pageinfo = response.json().get('data').get(owner_type).get('projectV2').get('items').get('pageInfo')
-    if pageinfo.get('hasNextPage'):
-        return get_project_issues(
-            owner=owner,
-            owner_type=owner_type,
-            project_number=project_number,
-            after=pageinfo.get('endCursor'),
-            filters=filters,
-            issues=issues,
+    updated_since = filters.get('updated_since')
+    if updated_since and (node.get('updatedAt') or '')[:10] < updated_since:
+        return False
+
+    shard = filters.get('shard')
+    if shard and sharding.shard_of(node['id'], shard[1]) != shard[0]:
+        return False
+
+    return True
+
+
+class GraphQLError(Exception):
+    """
+    Raised when a query keeps failing, and its data is needed to go on.
+    """
+
+
+class Page(list):
+    """
+    The items of one page, with the position of the page.
+
+    The position is a (search index, end cursor) tuple. Passed as resume to iter_project_issue_pages,
+    it continues with the page after this one.
+    """
+
+    def __init__(self, nodes, position):
+        super().__init__(nodes)
+        self.position = position
+
+
+def iter_project_issue_pages(owner, owner_type, project_number, filters=None, after=None, projection=None, resume=None,
+                             record=None):
+    """
+    Pages through the items of a project, yielding the (filtered) items of one page at a time.
+
+    Only the current page is held in memory, and the next page is requested when the consumer asks
+    for it, so processing can start as soon as the first page arrives.
+
+    When server side filters are enabled, the filters are sent as item search queries so that
+    non-matching items are never transferred. They are applied on the client as well, which keeps
+    the results correct wherever the search cannot express a filter.
+
+    :param projection: The item data to fetch, see build_items_query. Defaults to DEFAULT_PROJECTION.
+    :param resume: The position of a previously returned Page, to continue after it.
+    :param record: A function turning an item node into the record yielded instead, such as
+                   project_item.ProjectItem.from_node. The nodes are yielded as is by default.
+    :return: An iterator of Page objects.
+    """
+    filters = filters or {}
+    server_side = config.server_side_filters and bool(filters)
+    searches = build_item_searches(filters) if server_side else [None]
+
+    first_search = 0
+    if resume:
+        first_search, after = resume
+
+    # Shared by the searches, they page through the same kind of items
+    page_size = pagination.PageSizeController(
+        initial=config.page_size,
+        min_size=config.page_size_min,
+        max_size=config.page_size,
+        target_seconds=config.page_target_seconds
+    )
+
+    for index in range(first_search, len(searches)):
+        yield from _iter_item_search_pages(
+            owner, owner_type, project_number, filters, index, searches[index], after, projection or DEFAULT_PROJECTION,
+            record, page_size
         )
+        after = None
+
+
+def _iter_item_search_pages(owner, owner_type, project_number, filters, index, search, after, projection, record,
+                            page_size):
+    query = build_items_query(owner_type, projection, search=search is not None)
+
+    while True:
+        variables = {
+            'owner': owner,
+            'projectNumber': project_number,
+            'first': page_size.size,
+            'after': after
+        }
+        if search is not None:
+            variables['search'] = search
+
+        # Server errors are not retried as is, the page is requested again with fewer items
+        started = time.perf_counter()
+        response = transport.execute(query, variables, retry_server_errors=False)
+        seconds = time.perf_counter() - started
+
+        if response.get('errors'):
+            logger.info(response.get('errors'))
+
+        rate_limit = record_cost('GetProjectIssues', response)
+        if rate_limit:
+            logger.info(f"Items page cost {rate_limit['cost']} points, {rate_limit['remaining']} remaining")
+
+        items = ((((response.get('data') or {}).get(owner_type) or {}).get('projectV2')) or {}).get('items')
+        if items is None:
+            # Usually a timeout of the query on GitHub's side
+            at_min_size = page_size.size == page_size.min_size
+            if not page_size.failed():
+                raise GraphQLError(f"Could not fetch the items of project {owner}/{project_number}: {response.get('errors')}")
+            if at_min_size:
+                delay = transport.backoff_delay(page_size.failures - 1)
+                deadline.check(time.time() + delay)
+                time.sleep(delay)
+            continue
+
+        nodes = items.get('nodes')
+        page_size.observe(len(nodes), seconds, rate_limit['cost'] if rate_limit else None)
+
+        if filters:
+            nodes = [node for node in nodes if matches_filters(node, filters)]
+        if record:
+            nodes = [record(node) for node in nodes]
+
+        pageinfo = items.get('pageInfo')
+        yield Page(nodes, (index, pageinfo.get('endCursor') or after))
+
+        if not pageinfo.get('hasNextPage'):
+            return
+        after = pageinfo.get('endCursor')
+
+
+# Maximum number of ids GitHub accepts in a single nodes query
+MAX_NODE_IDS = 100
+
+
+def build_item_nodes_query(projection, issues=False):
+    """
+    Builds a query fetching project items by node id, together with the id of their project.
+
+    :param projection: The item data to fetch, see build_items_query.
+    :param issues: Whether the ids are issues, whose project items are fetched, instead of items.
+    """
+    selections = item_selections(projection) + ['project { id }']
+    item = ' '.join(selections)
+    if issues:
+        node = f"... on Issue {{ projectItems(first: 20) {{ nodes {{ {item} }} }} }}"
+        operation = 'GetIssueProjectItems'
+    else:
+        node = f"... on ProjectV2Item {{ {item} }}"
+        operation = 'GetProjectItems'
+
+    return f"""
+    query {operation}($ids: [ID!]!) {{
+        nodes(ids: $ids) {{
+            {node}
+        }}
+        rateLimit {{
+          cost
+          remaining
+          resetAt
+        }}
+    }}
+    """
+
+
+def _get_item_nodes(ids, projection, issues):
+    query = build_item_nodes_query(projection or DEFAULT_PROJECTION, issues=issues)
+    operation = 'GetIssueProjectItems' if issues else 'GetProjectItems'
 
-    return issues
+    nodes = []
+    for start in range(0, len(ids), MAX_NODE_IDS):
+        response = transport.execute(query, {'ids': ids[start:start + MAX_NODE_IDS]})
+        if response.get('errors'):
+            logger.info(response.get('errors'))
+        record_cost(operation, response)
+        # Deleted or inaccessible nodes come back as null
+        nodes += [node for node in (response.get('data') or {}).get('nodes') or [] if node]
+
+    return nodes
+
+
+def get_project_items(item_ids, projection=None):
+    """
+    Fetches project items by node id, instead of paging through their whole project.
+
+    :param projection: The item data to fetch, see build_items_query. Defaults to DEFAULT_PROJECTION.
+    :return: A list of items, each with the project it belongs to as project.id.
+    """
+    return [node for node in _get_item_nodes(item_ids, projection, issues=False) if node.get('id')]
+
+
+def get_issue_project_items(issue_ids, projection=None):
+    """
+    Fetches the project items of issues, in every project the issues have been added to.
+
+    :param projection: The item data to fetch, see build_items_query. Defaults to DEFAULT_PROJECTION.
+    :return: A list of items, each with the project it belongs to as project.id.
+    """
+    items = []
+    for node in _get_item_nodes(issue_ids, projection, issues=True):
+        items += (node.get('projectItems') or {}).get('nodes') or []
+
+    return items
 
 
 def get_issue(owner_name, repo_name, issue_number):
     # GraphQL query
     query = """
-    query($owner: String!, $repo: String!, $issueNumber: Int!) {
+    query GetIssue($owner: String!, $repo: String!, $issueNumber: Int!) {
         repository(owner: $owner, name: $repo) {
             issue(number: $issueNumber) {
                 id
@@ -200,6 +462,11 @@ def get_issue(owner_name, repo_name, issue_number):
                 }
             }
         }
+        rateLimit {
+          cost
+          remaining
+          resetAt
+        }
     }
     """
 
@@ -209,94 +476,96 @@ def get_issue(owner_name, repo_name, issue_number):
         'issueNumber': issue_number
     }
 
-    response = requests.post(
-        config.api_endpoint,
-        json={"query": query, "variables": variables},
-        headers={"Authorization": f"Bearer {config.gh_token}"}
-    )
-
     # Parse and return the issue details
-    data = response.json()
+    data = transport.execute(query, variables)
+    record_cost('GetIssue', data)
     return data.get('data', {}).get('repository', {}).get('issue', None)
 
 
-def add_issue_comment(issueId, comment):
-    mutation = """
-    mutation AddIssueComment($issueId: ID!, $comment: String!) {
-        addComment(input: {subjectId: $issueId, body: $comment}) {
-            clientMutationId
-        }
-    }
+def field_update_input(project_id, item_id, update):
     """
+    Builds the UpdateProjectV2ItemFieldValueInput for a single field update.
 
-    variables = {
-        'issueId': issueId,
-        'comment': comment
+    :param project_id: The ID of the project.
+    :param item_id: The ID of the item to update.
+    :param update: A dictionary with:
+                   - field_id: ID of the field to update
+                   - type: Type of the field ('single_select' or 'iteration')
+                   - value: The new value (singleSelectOptionId for single_select, iterationId for iteration)
+    :return: The input dictionary, or None if the field type is not supported.
+    """
+    input_value = {
+        "projectId": project_id,
+        "itemId": item_id,
+        "fieldId": update["field_id"],
+        "value": {}
     }
-    response = requests.post(
-        config.api_endpoint,
-        json={"query": mutation, "variables": variables},
-        headers={"Authorization": f"Bearer {config.gh_token}"}
-    )
-    if response.json().get('errors'):
-        logger.info(response.json().get('errors'))
 
-    return response.json().get('data')
+    if update["type"] == "single_select":
+        input_value["value"]["singleSelectOptionId"] = update["value"]
+    elif update["type"] == "iteration":
+        input_value["value"]["iterationId"] = update["value"]
+    else:
+        logger.info(f"Unsupported field type: {update['type']}")
+        return None
 
+    return input_value
 
-def update_project_item_fields(project_id, item_id, updates):
-    """
-    Updates multiple fields for a project item.
 
-    :param project_id: The ID of the project.
-    :param item_id: The ID of the item to update.
-    :param updates: A list of updates, where each update is a dictionary with:
-                    - field_id: ID of the field to update
-                    - type: Type of the field ('single_select' or 'iteration')
-                    - value: The new value (singleSelectOptionId for single_select, iterationId for iteration)
-    """
-    mutation = """
-    mutation UpdateProjectV2ItemFieldValue($input: UpdateProjectV2ItemFieldValueInput!) {
-      updateProjectV2ItemFieldValue(input: $input) {
-        projectV2Item {
-          id
-        }
-      }
-    }
-    """
+def comment_input(subject_id, comment):
+    return {"subjectId": subject_id, "body": comment}
 
-    headers = {
-        "Authorization": f"Bearer {config.gh_token}",  # Replace with your GitHub token
-        "Content-Type": "application/json"
-    }
 
-    for update in updates:
-        input_value = {
-            "projectId": project_id,
-            "itemId": item_id,
-            "fieldId": update["field_id"],
-            "value": {}
-        }
+# Mutation kind -> (input type, mutation field, selection)
+MUTATIONS = {
+    'update_field': ('UpdateProjectV2ItemFieldValueInput!', 'updateProjectV2ItemFieldValue', 'projectV2Item { id }'),
+    'comment': ('AddCommentInput!', 'addComment', 'clientMutationId'),
+}
 
-        if update["type"] == "single_select":
-            input_value["value"]["singleSelectOptionId"] = update["value"]
-        elif update["type"] == "iteration":
-            input_value["value"]["iterationId"] = update["value"]
-        else:
-            logger.info(f"Unsupported field type: {update['type']}")
-            continue
 
-        variables = {"input": input_value}
+def build_batched_mutation(operations):
+    """
+    Builds one aliased mutation document out of several operations.
 
-        response = requests.post(
-            config.api_endpoint,
-            json={"query": mutation, "variables": variables},
-            headers=headers
-        )
+    :param operations: A list of (kind, input) tuples, where kind is a key of MUTATIONS.
+    :return: A (document, variables) tuple. Operation i is aliased as op{i} and takes $input{i}.
+    """
+    definitions = []
+    selections = []
+    variables = {}
+    for index, (kind, input_value) in enumerate(operations):
+        input_type, field, selection = MUTATIONS[kind]
+        definitions.append(f"$input{index}: {input_type}")
+        selections.append(f"op{index}: {field}(input: $input{index}) {{ {selection} }}")
+        variables[f"input{index}"] = input_value
+
+    document = f"mutation BatchedMutation({', '.join(definitions)}) {{\n" + "\n".join(selections) + "\n}"
+    return document, variables
 
-        if response.status_code == 200:
-            response_data = response.json()
-            if response_data.get("errors"):
-                logger.info("Errors:", response_data["errors"])
+
+def run_batched_mutation(operations):
+    """
+    Sends several mutations in a single request and maps the errors back to the operations.
+
+    :param operations: A list of (kind, input) tuples, see build_batched_mutation.
+    :return: A dictionary mapping the index of every failed operation to its list of errors.
+    """
+    if not operations:
+        return {}
+
+    mutation, variables = build_batched_mutation(operations)
+    content_created = sum(1 for kind, _ in operations if kind == 'comment')
+    response = transport.execute(mutation, variables, content_created=content_created)
+
+    failed = {}
+    for error in response.get('errors') or []:
+        path = error.get('path') or []
+        alias = path[0] if path else None
+        if isinstance(alias, str) and alias.startswith('op') and alias[2:].isdigit():
+            failed.setdefault(int(alias[2:]), []).append(error)
         else:
-            logger.info(f"HTTP error {response.status_code}: {response.text}")
+            # Document level errors (parsing, validation) affect every operation
+            for index in range(len(operations)):
+                failed.setdefault(index, []).append(error)
+
+    return failed
@@ -0,0 +1,100 @@
+import hashlib
+import json
+import os
+import threading
+
+import config
+import sharding
+from logger import logger
+
+
+class Journal:
+    """
+    Progress journal of a project run, so that the next run can resume an interrupted one.
+
+    The journal is a JSON lines file: a start record with the signature of the run, followed by
+    the mutations applied so far and a checkpoint for every completed page. A run with the same
+    signature resumes after the last checkpoint, and mutations already applied are not sent again.
+    """
+
+    def __init__(self, path, signature):
+        self.path = path
+        self.lock = threading.Lock()
+        # Keys of the mutations applied, see update_key and comment_key
+        self.applied = set()
+        # Position of the last completed page, see graphql.Page
+        self.position = None
+        # (item id, summary) of the digest entries of the completed pages
+        self.digest = []
+
+        resumed = self._load(signature)
+        self.file = open(path, 'a' if resumed else 'w')
+        if resumed:
+            after = f" after page {self.position}" if self.position else ''
+            logger.info(f"Resuming{after} with {len(self.applied)} mutations already applied")
+        else:
+            self._write({'type': 'start', 'signature': signature})
+
+    def _load(self, signature):
+        try:
+            with open(self.path) as journal_file:
+                records = [json.loads(line) for line in journal_file if line.endswith('\n')]
+        except (OSError, ValueError):
+            return False
+
+        if not records or records[0].get('signature') != signature:
+            return False
+
+        for record in records[1:]:
+            if record['type'] == 'applied':
+                self.applied.update(tuple(key) for key in record['keys'])
+            elif record['type'] == 'checkpoint':
+                self.position = tuple(record['position'])
+                self.digest += [tuple(entry) for entry in record['digest']]
+
+        return True
+
+    def _write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def is_applied(self, key):
+        return key in self.applied
+
+    def record_applied(self, keys):
+        if keys:
+            with self.lock:
+                self.applied.update(keys)
+            self._write({'type': 'applied', 'keys': keys})
+
+    def checkpoint(self, position, digest=()):
+        """
+        Records a page as completed: its items are evaluated and their mutations applied.
+        """
+        self.position = position
+        self.digest += digest
+        self._write({'type': 'checkpoint', 'position': position, 'digest': list(digest)})
+
+    def complete(self):
+        """
+        Removes the journal once the run has finished, the next run starts from scratch.
+        """
+        self.file.close()
+        os.remove(self.path)
+
+    def close(self):
+        self.file.close()
+
+
+def update_key(item_id, update):
+    return (item_id, update['field_id'], update['value'])
+
+
+def comment_key(item_id, subject_id, comment):
+    return (item_id, subject_id, hashlib.sha1(comment.encode()).hexdigest())
+
+
+def open_journal(project_id, signature):
+    os.makedirs(config.cache_dir, exist_ok=True)
+    return Journal(os.path.join(config.cache_dir, f"journal-{project_id}{sharding.suffix()}.jsonl"), signature)
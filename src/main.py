@@ -1,37 +1,39 @@
+import json
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 from logger import logger
 import config
+import deadline
+import event
+import journal as progress_journal
+import plan
 import utils
 import graphql
+import project_schema
+from batcher import MutationBatcher
+from project_item import ProjectItem
+from metrics import metrics
 
 
-def fields_based_on_due_date(project, issue, updates):
-    # Extract all field nodes from the project
-    field_nodes = project["fields"]["nodes"]
-
-    # Identify the 'Release' and 'Week' fields by name
-    release_field = next((field for field in field_nodes if field and field["name"] == "Release"), None)
-    week_field = next((field for field in field_nodes if field and field["name"] == "Week"), None)
-
-    # Get the options for 'Release' and 'Week' fields
-    release_options = release_field['options']
-    week_options = week_field['configuration']['iterations'] + week_field['configuration']['completedIterations']
-
+def fields_based_on_due_date(schema, issue, updates):
     comment_fields = []
 
     # Skip processing if the issue does not have a due date
-    if not issue.get('dueDate'):
+    if not issue.due_date:
         return comment_fields
 
     # Retrieve the due date from the issue
-    due_date = issue.get('dueDate').get('date')
+    due_date = issue.due_date
     output = due_date
 
     # Handle missing 'week' field by finding the appropriate week based on the due date
-    week = utils.find_week(weeks=week_options, date_str=due_date)
-    if week and week != issue.get('week'):
+    week = schema.calendar.find_week(due_date)
+    if week and week['id'] != issue.week:
         # Add the 'week' field update to the updates list
         updates.append({
-            "field_id": week_field['id'],
+            "field_id": schema.week_field['id'],
             "type": "iteration",
             "value": week['id']
         })
@@ -39,11 +41,11 @@ def fields_based_on_due_date(project, issue, updates):
         comment_fields.append({'field': 'Week', 'value': week['title']})
 
     # Handle missing 'release' field by finding the appropriate release based on the due date
-    release = utils.find_release(releases=release_options, date_str=due_date)
-    if release and release != issue.get('release'):
+    release = schema.calendar.find_release(due_date)
+    if release and release['id'] != issue.release:
         # Add the 'release' field update to the updates list
         updates.append({
-            "field_id": release_field['id'],
+            "field_id": schema.release_field['id'],
             "type": "single_select",
             "value": release['id']
         })
@@ -56,30 +58,23 @@ def fields_based_on_due_date(project, issue, updates):
     return comment_fields
 
 
-def fields_based_on_estimation(project, issue, updates):
-    # Extract all field nodes from the project
-    field_nodes = project["fields"]["nodes"]
-
-    # Identify the 'Size' field by name
-    size_field = next((field for field in field_nodes if field and field["name"] == "Size"), None)
-    size_options = size_field['options']
-
+def fields_based_on_estimation(schema, issue, updates):
     comment_fields = []
 
     # Skip processing if the issue does not have an estimate
-    if not issue.get('estimate'):
+    if not issue.estimate:
         return comment_fields
 
     # Retrieve the estimate value from the issue
-    estimate = issue.get('estimate').get('name')
+    estimate = issue.estimate
     output = estimate
 
     # Find the size corresponding to the estimate and update if found
-    size = utils.find_size(sizes=size_options, estimate_name=estimate)
-    if size and size != issue.get('size'):
+    size = schema.find_size(estimate)
+    if size and size['id'] != issue.size:
         # Add the 'size' field update to the updates list
         updates.append({
-            "field_id": size_field['id'],
+            "field_id": schema.size_field['id'],
             "type": "single_select",
             "value": size['id']
         })
@@ -90,74 +85,518 @@ def fields_based_on_estimation(project, issue, updates):
     return comment_fields
 
 
-def update_fields(issues):
-    # Fetch the project details from GraphQL
-    project = graphql.get_project(
-        organization_name=config.repository_owner,
-        project_number=config.project_number
-    )
+# The rules applied to every item, with the item fields each of them reads
+RULES = [
+    (fields_based_on_estimation, ['estimate', 'size']),
+    (fields_based_on_due_date, ['dueDate', 'week', 'release']),
+]
 
-    comments_issue = None
-    if config.comments_issue_repo:
-        comments_issue = graphql.get_issue(
-            owner_name=config.repository_owner,
-            repo_name=config.comments_issue_repo,
-            issue_number=config.comments_issue_number
-        )
 
-    # Iterate over all issues to check and set missing fields
-    for issue in issues:
+def item_projection():
+    """
+    Declares the item data to fetch: the fields read by the rules, plus what the writers need.
+    """
+    fields = []
+    for _, rule_fields in RULES:
+        fields += [field for field in rule_fields if field not in fields]
+
+    return {
+        # The incremental sync compares the update times
+        'item': ['updatedAt'] if config.incremental else [],
+        'fields': fields,
+        # Comments need the issue id and url, the open_only filter its state
+        'content': ['id', 'url', 'state'],
+    }
+
+
+def item_filters():
+    # Items without a due date or an estimate are not touched by any rule
+    return {'open_only': True, 'has_any_field': ['dueDate', 'estimate']}
+
+
+def update_page(schema, page, batcher, summary, digest, store=None, comments_issue=None, planning=False):
+    """
+    Evaluates the rules for the issues of one page and queues the resulting mutations.
+
+    :param planning: Whether the batcher is a plan.PlanWriter. Nothing is sent then, so the mutations
+                     are recorded even in dry run mode.
+    """
+    if store:
+        import state
+
+    for issue in page:
+        summary['scanned'] += 1
+        if store and store.is_unchanged(schema.id, issue):
+            summary['skipped'] += 1
+            continue
+
         updates = []
         # Determine missing fields based on estimation and due date
-        comment_fields = fields_based_on_estimation(project, issue, updates)
-        comment_fields += fields_based_on_due_date(project, issue, updates)
+        comment_fields = []
+        with metrics.timer('rules'):
+            for rule, _ in RULES:
+                comment_fields += rule(schema, issue, updates)
 
         # Apply updates if not in dry run mode
         if updates:
+            summary['updated'] += 1
             # Constructing the comment
             comment = "The following fields have been updated:\n" + "\n".join(
                 [f"- {item['field']}: **{item['value']}**" for item in comment_fields]
             )
 
-            if not config.dry_run:
-                graphql.update_project_item_fields(
-                    project_id=project['id'],
-                    item_id=issue['id'],
-                    updates=updates
-                )
+            if planning or not config.dry_run:
+                batcher.add_field_updates(issue.id, updates)
 
                 # Add a comment summarizing the updated fields
-                if comments_issue:
-                    comment = f"Issue {issue['content']['url']}: {comment}"
-                    graphql.add_issue_comment(comments_issue['id'], comment)
+                if comments_issue and config.comments_digest:
+                    comment = f"Issue {issue.url}: {comment}"
+                    digest.append((issue.id, comment))
+                elif comments_issue:
+                    comment = f"Issue {issue.url}: {comment}"
+                    batcher.add_comment(issue.id, comments_issue['id'], comment)
                 else:
-                    graphql.add_issue_comment(issue['content']['id'], comment)
+                    batcher.add_comment(issue.id, issue.content_id, comment)
 
             # Log the output
-            logger.info(f"Comment has been added to: {issue['content']['url']} with comment {comment}")
+            if planning:
+                logger.info(f"Planned updates of {issue.url} with comment {comment}")
+            else:
+                logger.info(f"Comment has been added to: {issue.url} with comment {comment}")
+
+        if store and not config.dry_run:
+            store.record(schema.id, issue, state.apply_updates(state.item_values(issue), schema, updates))
+
+
+def update_fields(schema, pages, store=None, comments_issue=None, journal=None, plan=None):
+    """
+    Evaluates the rules for every issue and applies the resulting field updates.
+
+    Processing stops before the next page once the deadline is reached, or as soon as waiting would
+    run past it, with the counts of what has been done. With a journal, the page is checkpointed once
+    its mutations have been applied, and the digest entries of the pages completed by an earlier,
+    interrupted run are carried over.
+
+    :param schema: The ProjectSchema of the project.
+    :param pages: An iterable of pages (lists) of ProjectItem records, consumed once.
+    :param store: An optional state.StateStore, items unchanged since the last run are skipped.
+    :param comments_issue: The issue receiving the comments, by default each item's own issue is used.
+    :param journal: An optional journal.Journal recording the progress.
+    :param plan: An optional plan.Plan collecting the mutations, which are then not sent.
+    :return: A dictionary with the number of items scanned, skipped, updated and failed, and whether
+             the run was interrupted.
+    """
+    executor = None
+    if plan:
+        batcher = plan.writer(schema.id)
+    else:
+        executor = ThreadPoolExecutor(max_workers=config.concurrency) if config.concurrency > 1 else None
+        batcher = MutationBatcher(
+            project_id=schema.id,
+            batch_size=config.mutation_batch_size,
+            executor=executor,
+            max_in_flight=config.concurrency * 2,
+            journal=journal
+        )
+
+    # (item id, summary) of the updated items, when the summaries are posted as a digest
+    digest = list(journal.digest) if journal else []
+
+    # Iterate over all issues to check and set missing fields
+    summary = {'scanned': 0, 'skipped': 0, 'updated': 0, 'commented': 0, 'failed': 0, 'interrupted': False}
+    # The digest comments, once they are queued
+    summaries = bodies = None
+    try:
+        for page in pages:
+            if deadline.reached():
+                logger.info('Deadline reached, stopping before the next page')
+                summary['interrupted'] = True
+                break
+
+            page_digest_start = len(digest)
+            update_page(schema, page, batcher, summary, digest, store, comments_issue, planning=plan is not None)
+
+            if journal:
+                # The page only counts as completed once its mutations went through
+                batcher.flush()
+                batcher.wait()
+                journal.checkpoint(
+                    page.position,
+                    [entry for entry in digest[page_digest_start:] if entry[0] not in batcher.failed]
+                )
+
+        # With a journal, the digest of an interrupted run is posted by the run completing the project.
+        # Without one, the items applied so far would never be summarized, so they are now.
+        if digest and not (summary['interrupted'] and journal):
+            # Only summarize the items whose updates went through
+            batcher.flush()
+            batcher.wait()
+            summaries = [summary for item_id, summary in digest if item_id not in batcher.failed]
+            bodies = utils.split_digest(summaries, header="The following issues have been updated:")
+            for body in bodies:
+                batcher.add_comment(comments_issue['id'], comments_issue['id'], body)
+
+        # Send whatever is left in the last, partially filled batches
+        with metrics.timer('mutations'):
+            batcher.close()
+    except deadline.DeadlineExceeded as error:
+        # What has been sent stays applied, and is counted below
+        logger.info(f"Stopping: {error}")
+        summary['interrupted'] = True
+    finally:
+        if executor:
+            executor.shutdown()
+
+    if summaries is not None:
+        sent = batcher.comments_sent >= len(bodies) and comments_issue['id'] not in batcher.failed
+        summary['commented'] = len(summaries) if sent else 0
+    else:
+        summary['commented'] = batcher.comments_sent
+
+    if batcher.failed:
+        summary['failed'] = len(batcher.failed)
+        logger.info(f"{len(batcher.failed)} items could not be updated")
+        if store:
+            # Evaluate the failed items again on the next run
+            store.forget(schema.id, batcher.failed)
+
+    return summary
+
+
+def get_comments_issue():
+    if not config.comments_issue_repo:
+        return None
+
+    return graphql.get_issue(
+        owner_name=config.repository_owner,
+        repo_name=config.comments_issue_repo,
+        issue_number=config.comments_issue_number
+    )
+
+
+def load_schema(owner, project_number):
+    # Fetch the project fields, or reuse them from the schema cache
+    with metrics.timer('schema'):
+        return project_schema.load(
+            owner=owner,
+            project_number=project_number,
+            owner_type=config.repository_owner_type
+        )
+
+
+def iter_pages(owner, project_number, filters, resume=None):
+    # The next page is fetched in the background while the current one is processed
+    return utils.prefetch(graphql.iter_project_issue_pages(
+        owner=owner,
+        owner_type=config.repository_owner_type,
+        project_number=project_number,
+        filters=filters,
+        projection=item_projection(),
+        resume=resume,
+        record=ProjectItem.from_node
+    ))
+
+
+def run_project(owner, project_number, comments_issue=None, event_items=None, plan=None):
+    """
+    Processes one project.
+
+    :param comments_issue: A concurrent.futures.Future of the comments issue, see get_comments_issue,
+                           waited for once the project is ready to be processed.
+    :param event_items: The items of the triggering event, see event.fetch_items. Only those of this
+                        project are processed, instead of every item.
+    :param plan: An optional plan.Plan collecting the mutations instead of sending them.
+    :return: The summary of update_fields, with the project it belongs to.
+    """
+    filters = item_filters()
+    if config.shard_count > 1:
+        # Every job of a sharded run reads all items, but only evaluates and writes its own
+        filters['shard'] = [config.shard_index, config.shard_count]
+
+    if event_items is not None:
+        # The event names the items, there is no need to page through the project
+        schema = load_schema(owner, project_number)
+        items = [
+            ProjectItem.from_node(item) for item in event_items
+            if (item.get('project') or {}).get('id') == schema.id and graphql.matches_filters(item, filters)
+        ]
+        comments_issue = comments_issue.result() if comments_issue else None
+        summary = update_fields(schema, [items], comments_issue=comments_issue, plan=plan)
+    else:
+        summary = scan_project(owner, project_number, filters, comments_issue, plan)
+
+    for key in ('scanned', 'skipped', 'updated', 'commented', 'failed'):
+        metrics.count_items(key, summary[key])
+
+    summary['project'] = f"{owner}/{project_number}"
+    return summary
+
+
+def scan_project(owner, project_number, filters, comments_issue=None, plan=None):
+    """
+    Processes every item of a project matching the filters, page by page.
+
+    Without a state store or a journal, which depend on the project id, the first pages are fetched
+    while the schema is loaded and compiled, so that the first mutations go out as early as possible.
+
+    :param comments_issue: A concurrent.futures.Future of the comments issue, see run_project.
+    :return: The summary of update_fields.
+    """
+    started_at = time.time()
+
+    # The state store and the journal track what has been applied, a plan applies nothing
+    tracked = (config.incremental or config.resumable) and not plan
+    pages = None if tracked else iter_pages(owner, project_number, filters)
+
+    try:
+        schema = load_schema(owner, project_number)
+
+        store = None
+        if config.incremental and not plan:
+            # The optional modes import their modules when enabled, to keep the startup of a plain run short
+            import state
+            store = state.open_store(schema.id)
+            context = state.schema_context(schema)
+            updated_since = store.begin(schema.id, context)
+            if updated_since:
+                filters['updated_since'] = updated_since
+
+        # A resumable run picks up after the last completed page of an interrupted run with the same settings
+        journal = None
+        if config.resumable and not plan:
+            signature = json.dumps([schema.id, filters, item_projection()], sort_keys=True)
+            journal = progress_journal.open_journal(schema.id, signature)
+
+        # Fetch all open issues from the project
+        if pages is None:
+            pages = iter_pages(owner, project_number, filters, resume=journal.position if journal else None)
+
+        # Process the issues to update fields
+        comments_issue = comments_issue.result() if comments_issue else None
+        summary = update_fields(schema, metrics.timed(pages, 'pagination'), store, comments_issue, journal, plan)
+    finally:
+        # Stops the pagination when processing stopped early, or before it started
+        if pages is not None:
+            pages.close()
+
+    if journal:
+        if summary['interrupted']:
+            journal.close()
+        else:
+            journal.complete()
+
+    if store:
+        # An interrupted run has not seen every item, the next run must not skip the rest
+        if not config.dry_run and not summary['interrupted']:
+            store.finish(schema.id, context, started_at, full=updated_since is None)
+        store.close()
+
+    return summary
+
+
+def export_snapshot(path):
+    """
+    Writes the schema and the items of every project to a snapshot, see snapshot.py.
+    """
+    import snapshot
+
+    writer = snapshot.SnapshotWriter(path)
+    try:
+        for owner, project_number in config.projects:
+            pages = iter_pages(owner, project_number, item_filters())
+            try:
+                writer.add_project(owner, project_number, load_schema(owner, project_number))
+                for page in metrics.timed(pages, 'pagination'):
+                    writer.add_items(page)
+            finally:
+                pages.close()
+    finally:
+        writer.close()
+
+
+def evaluate_snapshot(path):
+    """
+    Runs the rules over a snapshot without any request, and reports what a run would change.
+
+    The mutations go to a plan, which is written to config.plan_file when it is set.
+    """
+    import snapshot
+
+    what_if = plan.Plan()
+    for owner, project_number, schema, pages in snapshot.read(path):
+        summary = update_fields(schema, pages, plan=what_if)
+
+        # Field id -> number of items it would be set on
+        fields = {}
+        for (project_id, _), entry in what_if.items.items():
+            if project_id == schema.id:
+                for update in entry['updates']:
+                    fields[update['field_id']] = fields.get(update['field_id'], 0) + 1
+        names = {field['id']: name for name, field in schema.fields.items()}
+        changes = ', '.join(f"{names.get(field_id, field_id)}: {count}" for field_id, count in sorted(fields.items()))
+        logger.info(
+            f"Project {owner}/{project_number}: {summary['scanned']} items evaluated, "
+            f"{summary['updated']} would be updated ({changes or 'no field changes'})"
+        )
+        for key in ('scanned', 'updated'):
+            metrics.count_items(key, summary[key])
+
+    if config.plan_file:
+        what_if.write(config.plan_file)
+
+
+class ProjectsFailed(Exception):
+    """
+    Raised at the end of a pass in which some projects failed, once the others have been processed.
+    """
 
 
 def main():
+    try:
+        run()
+    except ProjectsFailed as e:
+        # The failures have been logged with their tracebacks
+        logger.info(str(e))
+        sys.exit(1)
+    finally:
+        metrics.write_reports()
+
+
+def run():
     # Log the start of the process
     logger.info('Process started...')
+    deadline.start()
     if config.dry_run:
         logger.info('DRY RUN MODE ON!')
+    for name in config.ignored_without_cache_dir:
+        logger.warning(f"Ignoring {name}, it needs cache_dir to keep its state between runs")
 
-    # Fetch all open issues from the project
-    issues = graphql.get_project_issues(
-        owner=config.repository_owner,
-        owner_type=config.repository_owner_type,
-        project_number=config.project_number,
-        filters={'open_only': True}
-    )
+    if config.merge_metrics:
+        # The final step of a sharded run, combining the metrics written by every shard
+        metrics.merge_files(config.merge_metrics)
+        return
 
-    # Exit if no issues are found
-    if not issues:
-        logger.info('No issues have been found')
+    if config.shard_count > 1:
+        logger.info(f"Processing shard {config.shard_index} of {config.shard_count}")
+
+    if config.snapshot_export:
+        export_snapshot(config.snapshot_export)
+        return
+
+    if config.snapshot_evaluate:
+        # Offline, for trying out rule changes without any request
+        evaluate_snapshot(config.snapshot_evaluate)
+        return
+
+    if config.apply_plan:
+        # The rules have been evaluated by the run that wrote the plan
+        plan.apply(config.apply_plan)
+        return
+
+    if config.daemon:
+        # Stay resident and process the projects on every trigger, reusing the comments issue once fetched
+        import daemon
+        comments_issue = utils.background(get_comments_issue)
+
+        def process(targets):
+            nonlocal comments_issue
+            # A failed fetch, such as a network error, is retried by the next pass
+            if comments_issue.done() and comments_issue.exception():
+                comments_issue = utils.background(get_comments_issue)
+            run_triggered(targets, comments_issue)
+
+        daemon.serve(process)
+        return
+
+    # An issue or project item event only needs its own items to be processed
+    targets = event.event_targets(config.event_name, event.read_payload())
+    if targets == ([], []):
+        logger.info('The event has no items to process')
+        return
+
+    # The comments issue, the schemas and the event items do not depend on each other, they are
+    # fetched concurrently. The comments of every project go to the same issue, fetched once.
+    comments_issue = utils.background(get_comments_issue)
+    for owner, project_number in config.projects:
+        project_schema.preload(owner, project_number, owner_type=config.repository_owner_type)
+    event_items = None if targets is None else event.fetch_items(*targets, item_projection())
+    if event_items == []:
+        logger.info('The event has no items to process')
+        return
+
+    run_pass(comments_issue, event_items)
+
+
+def run_triggered(targets, comments_issue=None):
+    """
+    Runs the pass of a daemon trigger.
+
+    :param targets: The (item ids, issue ids) to process, see event.event_targets, or None for all items.
+    :param comments_issue: A concurrent.futures.Future of the comments issue, see run_project.
+    """
+    deadline.start()
+    # The costs are logged per pass
+    graphql.query_costs.clear()
+    event_items = None if targets is None else event.fetch_items(*targets, item_projection())
+    if event_items == []:
+        logger.info('The triggers have no items to process')
         return
 
-    # Process the issues to update fields
-    update_fields(issues)
+    run_pass(comments_issue, event_items)
+
+
+def run_pass(comments_issue=None, event_items=None):
+    """
+    Processes every configured project, or only the given event items in them.
+
+    :param comments_issue: A concurrent.futures.Future of the comments issue, see run_project.
+    :param event_items: The items to process, see run_project. All items are processed when None.
+    """
+    # With a plan file, the mutations of every project are written to it instead of being sent
+    run_plan = plan.Plan() if config.plan_file else None
+
+    def process(project):
+        # A failing project must not lose the summaries of the others
+        try:
+            return run_project(*project, comments_issue=comments_issue, event_items=event_items, plan=run_plan)
+        except Exception as e:
+            logger.exception(f"Project {project[0]}/{project[1]} failed: {e}")
+            return None
+
+    # The projects share the connection pool, the rate limiter and the schema cache
+    if len(config.projects) == 1:
+        results = [process(config.projects[0])]
+    else:
+        with ThreadPoolExecutor(max_workers=config.project_concurrency) as executor:
+            results = list(executor.map(process, config.projects))
+
+    summaries = [summary for summary in results if summary is not None]
+    failed = [f"{owner}/{number}" for (owner, number), summary in zip(config.projects, results) if summary is None]
+
+    if run_plan:
+        run_plan.write(config.plan_file)
+
+    for summary in summaries:
+        logger.info(
+            f"Project {summary['project']}: {summary['scanned']} scanned, {summary['skipped']} skipped, "
+            f"{summary['updated']} updated, {summary['commented']} commented, {summary['failed']} failed"
+        )
+        if summary['interrupted'] and config.resumable and not run_plan:
+            logger.info(f"Project {summary['project']} was interrupted by the deadline and continues on the next run")
+        elif summary['interrupted']:
+            logger.info(f"Project {summary['project']} was interrupted by the deadline")
+
+    if graphql.query_costs:
+        costs = ', '.join(f"{operation}: {cost}" for operation, cost in graphql.query_costs.items())
+        logger.info(f"Query cost: {sum(graphql.query_costs.values())} points ({costs})")
+
+    if failed:
+        raise ProjectsFailed(f"{len(failed)} of {len(config.projects)} projects failed: {', '.join(failed)}")
+
+    # Log if no issues are found
+    if not any(summary['scanned'] for summary in summaries):
+        logger.info('No issues have been found')
+        return
 
     logger.info('Process finished...')
 
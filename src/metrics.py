@@ -0,0 +1,264 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+from logger import logger
+
+# Upper bounds in seconds of the duration histogram buckets
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+PREFIX = 'gh_project_automations'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def merge(self, data):
+        """
+        Adds the observations of another histogram, as returned by to_dict.
+        """
+        for index, bound in enumerate(BUCKETS):
+            self.counts[index] += data['buckets'].get(str(bound), 0)
+        self.count += data['count']
+        self.sum += data['sum']
+        self.max = max(self.max, data['max'])
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'buckets': {str(bound): count for bound, count in zip(BUCKETS, self.counts)},
+        }
+
+
+class Metrics:
+    """
+    Collects the metrics of a run: request timings, counts and sizes per GraphQL operation, time
+    spent per phase, the remaining rate limit points and the item counts.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        # operation -> {'requests', 'errors', 'retries', 'bytes_sent', 'bytes_received'}
+        self.operations = {}
+        # operation -> Histogram of the request durations
+        self.request_durations = {}
+        # phase -> Histogram of the phase durations
+        self.phase_durations = {}
+        # item state (scanned, skipped, updated, failed, commented) -> count
+        self.items = {}
+        self.rate_limit_remaining = None
+        # The duration of merged runs, which replaces the time since started_at
+        self.duration = None
+
+    def observe_request(self, operation, duration, bytes_sent, bytes_received, error=False, retry=False):
+        with self.lock:
+            counters = self.operations.setdefault(
+                operation, {'requests': 0, 'errors': 0, 'retries': 0, 'bytes_sent': 0, 'bytes_received': 0}
+            )
+            counters['requests'] += 1
+            counters['errors'] += 1 if error else 0
+            counters['retries'] += 1 if retry else 0
+            counters['bytes_sent'] += bytes_sent
+            counters['bytes_received'] += bytes_received
+            self.request_durations.setdefault(operation, Histogram()).observe(duration)
+
+    def observe_error(self, operation):
+        with self.lock:
+            if operation in self.operations:
+                self.operations[operation]['errors'] += 1
+
+    def observe_rate_limit(self, remaining):
+        self.rate_limit_remaining = remaining
+
+    def observe_phase(self, phase, duration):
+        with self.lock:
+            self.phase_durations.setdefault(phase, Histogram()).observe(duration)
+
+    @contextmanager
+    def timer(self, phase):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe_phase(phase, time.perf_counter() - started)
+
+    def timed(self, iterable, phase):
+        """
+        Yields from an iterable, timing how long every value takes to arrive.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                value = next(iterator)
+            except StopIteration:
+                return
+            self.observe_phase(phase, time.perf_counter() - started)
+            yield value
+
+    def count_items(self, state, count=1):
+        with self.lock:
+            self.items[state] = self.items.get(state, 0) + count
+
+    def merge(self, data):
+        """
+        Adds the metrics of another run, as returned by to_dict, such as those of the shards of a
+        sharded run. The merged run lasts as long as its longest run.
+        """
+        with self.lock:
+            for operation, counters in data['operations'].items():
+                merged = self.operations.setdefault(operation, dict.fromkeys(counters, 0))
+                for key, value in counters.items():
+                    merged[key] = merged.get(key, 0) + value
+            for histograms, merged in (
+                (data['request_durations'], self.request_durations),
+                (data['phase_durations'], self.phase_durations),
+            ):
+                for name, histogram in histograms.items():
+                    merged.setdefault(name, Histogram()).merge(histogram)
+            for state, count in data['items'].items():
+                self.items[state] = self.items.get(state, 0) + count
+            if data['rate_limit_remaining'] is not None:
+                self.rate_limit_remaining = min(
+                    data['rate_limit_remaining'],
+                    self.rate_limit_remaining if self.rate_limit_remaining is not None else data['rate_limit_remaining']
+                )
+            self.duration = max(self.duration or 0, data['duration'])
+
+    def merge_files(self, pattern):
+        """
+        Merges the metrics JSON files matching a glob pattern into these metrics.
+        """
+        paths = sorted(glob.glob(pattern))
+        for path in paths:
+            with open(path) as metrics_file:
+                self.merge(json.load(metrics_file))
+        logger.info(f"Merged the metrics of {len(paths)} runs: {', '.join(paths)}")
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'duration': self.duration if self.duration is not None else time.time() - self.started_at,
+                'operations': {operation: dict(counters) for operation, counters in self.operations.items()},
+                'request_durations': {name: histogram.to_dict() for name, histogram in self.request_durations.items()},
+                'phase_durations': {name: histogram.to_dict() for name, histogram in self.phase_durations.items()},
+                'items': dict(self.items),
+                'rate_limit_remaining': self.rate_limit_remaining,
+            }
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = [
+            f"# TYPE {PREFIX}_run_duration_seconds gauge",
+            f"{PREFIX}_run_duration_seconds {data['duration']}",
+        ]
+
+        counters = (
+            ('requests', 'requests_total'),
+            ('errors', 'request_errors_total'),
+            ('retries', 'request_retries_total'),
+            ('bytes_sent', 'bytes_sent_total'),
+            ('bytes_received', 'bytes_received_total'),
+        )
+        for key, name in counters:
+            lines.append(f"# TYPE {PREFIX}_{name} counter")
+            for operation, values in data['operations'].items():
+                lines.append(f'{PREFIX}_{name}{{operation="{operation}"}} {values[key]}')
+
+        for name, label, histograms in (
+            ('request_duration_seconds', 'operation', data['request_durations']),
+            ('phase_duration_seconds', 'phase', data['phase_durations']),
+        ):
+            lines.append(f"# TYPE {PREFIX}_{name} histogram")
+            for value, histogram in histograms.items():
+                cumulative = 0
+                for bound, count in histogram['buckets'].items():
+                    cumulative += count
+                    le = '+Inf' if bound == 'inf' else bound
+                    lines.append(f'{PREFIX}_{name}_bucket{{{label}="{value}",le="{le}"}} {cumulative}')
+                lines.append(f'{PREFIX}_{name}_sum{{{label}="{value}"}} {histogram["sum"]}')
+                lines.append(f'{PREFIX}_{name}_count{{{label}="{value}"}} {histogram["count"]}')
+
+        lines.append(f"# TYPE {PREFIX}_items_total counter")
+        for state, count in data['items'].items():
+            lines.append(f'{PREFIX}_items_total{{state="{state}"}} {count}')
+
+        if data['rate_limit_remaining'] is not None:
+            lines.append(f"# TYPE {PREFIX}_rate_limit_remaining gauge")
+            lines.append(f"{PREFIX}_rate_limit_remaining {data['rate_limit_remaining']}")
+
+        return '\n'.join(lines) + '\n'
+
+    def to_markdown(self):
+        data = self.to_dict()
+        lines = [
+            '### Project automations',
+            '',
+            f"Run time: {data['duration']:.1f}s, rate limit points remaining: {data['rate_limit_remaining']}",
+            '',
+            '| Items | Count |',
+            '| --- | ---: |',
+        ]
+        lines += [f"| {state} | {count} |" for state, count in data['items'].items()]
+        lines += [
+            '',
+            '| Operation | Requests | Errors | Retries | Avg s | Max s | KB sent | KB received |',
+            '| --- | ---: | ---: | ---: | ---: | ---: | ---: | ---: |',
+        ]
+        for operation, values in data['operations'].items():
+            histogram = data['request_durations'][operation]
+            lines.append(
+                f"| {operation} | {values['requests']} | {values['errors']} | {values['retries']} "
+                f"| {histogram['sum'] / histogram['count']:.3f} | {histogram['max']:.3f} "
+                f"| {values['bytes_sent'] / 1024:.1f} | {values['bytes_received'] / 1024:.1f} |"
+            )
+        lines += ['', '| Phase | Seconds |', '| --- | ---: |']
+        lines += [f"| {phase} | {histogram['sum']:.2f} |" for phase, histogram in data['phase_durations'].items()]
+
+        return '\n'.join(lines) + '\n'
+
+    def write_reports(self):
+        """
+        Writes the JSON summary and the Prometheus textfile when configured, and appends the
+        summary to the GitHub step summary.
+        """
+        if config.metrics_json:
+            write_atomic(config.metrics_json, json.dumps(self.to_dict(), indent=2))
+        if config.metrics_prometheus:
+            write_atomic(config.metrics_prometheus, self.to_prometheus())
+        if config.step_summary:
+            with open(config.step_summary, 'a') as summary:
+                summary.write(self.to_markdown())
+
+
+def write_atomic(path, content):
+    # Collectors such as the node exporter must never read a partially written file
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(f"{path}.tmp", 'w') as output:
+        output.write(content)
+    os.replace(f"{path}.tmp", path)
+
+
+metrics = Metrics()
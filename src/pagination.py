@@ -0,0 +1,71 @@
+import config
+from logger import logger
+
+# GitHub returns at most 100 nodes per connection page
+MAX_PAGE_SIZE = 100
+
+
+class PageSizeController:
+    """
+    Adapts the number of items requested per page to how the API copes with them.
+
+    A page answered in more than target_seconds shrinks the next one in proportion, and a failed
+    page, usually GitHub's server-side timeout on projects with many fields, is requested again at
+    half the size, which then stays the largest size of the run. Pages answered in under half the
+    target grow the next one, as long as they did not cost more rate limit points per item than
+    the page before: fewer, larger pages cost fewer points and round trips for the same items.
+    """
+
+    def __init__(self, initial, min_size, max_size, target_seconds):
+        self.min_size = max(1, min_size)
+        self.max_size = min(MAX_PAGE_SIZE, max(self.min_size, max_size))
+        self.size = min(self.max_size, max(self.min_size, initial))
+        self.target_seconds = target_seconds
+        self.cost_per_item = None
+        # Largest size to grow to, lowered by failures
+        self.ceiling = self.max_size
+        # Consecutive failed pages
+        self.failures = 0
+
+    def observe(self, items, seconds, cost=None):
+        """
+        Adjusts the page size after a successful page.
+
+        :param items: The number of items the page returned, before any client side filtering.
+        :param seconds: The response time of the page.
+        :param cost: The rateLimit cost of the page, when known.
+        """
+        self.failures = 0
+        cost_per_item = cost / items if cost is not None and items else None
+        cheaper = cost_per_item is None or self.cost_per_item is None or cost_per_item <= self.cost_per_item
+        if cost_per_item is not None:
+            self.cost_per_item = cost_per_item
+
+        if seconds > self.target_seconds:
+            size = max(self.min_size, int(self.size * self.target_seconds / seconds))
+        elif seconds < self.target_seconds / 2 and cheaper:
+            size = min(self.ceiling, self.size * 2)
+        else:
+            return
+
+        if size != self.size:
+            logger.info(f"Items page of {self.size} took {seconds:.1f}s, requesting {size} items per page")
+            self.size = size
+
+    def failed(self):
+        """
+        Shrinks the page size after a failed page.
+
+        :return: Whether the page should be requested again, False once it has failed
+                 config.http_max_retries times in a row.
+        """
+        self.failures += 1
+        if self.failures > config.http_max_retries:
+            return False
+
+        size = max(self.min_size, self.size // 2)
+        logger.info(f"Items page of {self.size} failed, retrying with {size} items per page")
+        self.size = size
+        # Growing back would run into the same failures
+        self.ceiling = min(self.ceiling, size)
+        return True
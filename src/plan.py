@@ -0,0 +1,158 @@
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import deadline
+from batcher import MutationBatcher
+from journal import Journal
+from logger import logger
+from metrics import metrics
+
+# Bump when the plan format changes, older plans are then rejected
+PLAN_VERSION = 1
+
+
+class Plan:
+    """
+    The mutations of a run, collected instead of sent, per project and item.
+
+    A plan is written as JSON lines: a header, then one line per item with its field updates and
+    comments, sorted by project and item so that the plans of two runs can be diffed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (project id, item id) -> {'updates': [...], 'comments': [...]}
+        self.items = {}
+
+    def writer(self, project_id):
+        return PlanWriter(self, project_id)
+
+    def entry(self, project_id, item_id):
+        with self.lock:
+            return self.items.setdefault((project_id, item_id), {'updates': [], 'comments': []})
+
+    def write(self, path):
+        with open(path, 'w') as plan_file:
+            plan_file.write(json.dumps({'version': PLAN_VERSION, 'created_at': int(time.time())}) + '\n')
+            for (project_id, item_id), entry in sorted(self.items.items()):
+                plan_file.write(json.dumps({'project_id': project_id, 'item_id': item_id, **entry}, sort_keys=True) + '\n')
+
+        updates = sum(len(entry['updates']) for entry in self.items.values())
+        comments = sum(len(entry['comments']) for entry in self.items.values())
+        logger.info(f"Plan written to {path}: {len(self.items)} items, {updates} field updates, {comments} comments")
+
+
+class PlanWriter:
+    """
+    Records the mutations of one project in a Plan, in place of a batcher.MutationBatcher.
+    """
+
+    def __init__(self, plan, project_id):
+        self.plan = plan
+        self.project_id = project_id
+        # Nothing is sent, so nothing fails
+        self.failed = {}
+        self.comments_sent = 0
+
+    def add_field_updates(self, item_id, updates):
+        self.plan.entry(self.project_id, item_id)['updates'].extend(updates)
+
+    def add_comment(self, item_id, subject_id, comment):
+        self.plan.entry(self.project_id, item_id)['comments'].append({'subject_id': subject_id, 'body': comment})
+        self.comments_sent += 1
+
+    def flush(self):
+        pass
+
+    def wait(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def read(path):
+    """
+    Reads a plan file.
+
+    :return: A (header, entries) tuple, with the header line and the list of the item entries.
+    """
+    with open(path) as plan_file:
+        header = json.loads(plan_file.readline())
+        if header.get('version') != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version {header.get('version')} in {path}")
+        return header, [json.loads(line) for line in plan_file if line.strip()]
+
+
+def apply(path):
+    """
+    Executes the mutations of a saved plan.
+
+    Writes are deduplicated: the last update of a field of an item wins, and a comment is posted
+    once per subject and body. Every field update of a project is sent before its comments, and the
+    comments of items whose updates failed are dropped.
+
+    The mutations applied are recorded in a journal next to the plan, {path}.journal, and are not sent
+    again when the plan is applied once more, after a crash, the deadline or a completed apply.
+
+    :return: A dictionary with the number of items, of the updates and comments sent and of failed
+             items, and whether the apply was interrupted by the deadline.
+    """
+    header, entries = read(path)
+    journal = Journal(f"{path}.journal", json.dumps([os.path.abspath(path), header], sort_keys=True))
+
+    # project id -> item id -> field id -> update, and project id -> {(item id, subject id, body)}
+    updates = {}
+    comments = {}
+    for entry in entries:
+        fields = updates.setdefault(entry['project_id'], {}).setdefault(entry['item_id'], {})
+        for update in entry['updates']:
+            fields[update['field_id']] = update
+        project_comments = comments.setdefault(entry['project_id'], {})
+        for comment in entry['comments']:
+            project_comments.setdefault((comment['subject_id'], comment['body']), entry['item_id'])
+
+    summary = {'items': 0, 'updates': 0, 'comments': 0, 'failed': 0, 'interrupted': False}
+    executor = ThreadPoolExecutor(max_workers=config.concurrency) if config.concurrency > 1 else None
+    try:
+        for project_id, items in updates.items():
+            batcher = MutationBatcher(
+                project_id=project_id,
+                batch_size=config.mutation_batch_size,
+                executor=executor,
+                max_in_flight=config.concurrency * 2,
+                journal=journal
+            )
+            summary['items'] += len(items)
+            applied = len(journal.applied)
+            try:
+                for item_id, fields in items.items():
+                    batcher.add_field_updates(item_id, list(fields.values()))
+                for (subject_id, body), item_id in comments.get(project_id, {}).items():
+                    batcher.add_comment(item_id, subject_id, body)
+
+                with metrics.timer('mutations'):
+                    batcher.close()
+            finally:
+                # The journal holds every mutation sent successfully, comments included
+                summary['updates'] += len(journal.applied) - applied - batcher.comments_sent
+                summary['comments'] += batcher.comments_sent
+                summary['failed'] += len(batcher.failed)
+    except deadline.DeadlineExceeded as error:
+        # Everything applied so far is in the journal, applying the plan again sends the rest
+        logger.info(f"Stopping: {error}")
+        summary['interrupted'] = True
+    finally:
+        if executor:
+            executor.shutdown()
+        journal.close()
+
+    logger.info(
+        f"Plan {path} {'partially applied' if summary['interrupted'] else 'applied'}: {summary['items']} items, "
+        f"{summary['updates']} field updates, {summary['comments']} comments, {summary['failed']} failed"
+    )
+    return summary
@@ -0,0 +1,54 @@
+import sys
+
+
+def _intern(value):
+    # Option and iteration ids repeat across thousands of items, keep a single copy of each
+    return sys.intern(value) if value is not None else None
+
+
+class ProjectItem:
+    """
+    Compact record of a project item, holding only the ids and values the rules and writers use.
+
+    Items are reduced to records as soon as their page is decoded, so the nested response data is
+    released right away. Field values that were not fetched, or are not set, are None.
+    """
+
+    __slots__ = ('id', 'updated_at', 'content_id', 'url', 'due_date', 'estimate', 'release', 'week', 'size')
+
+    def __init__(self, id, updated_at=None, content_id=None, url=None, due_date=None, estimate=None,
+                 release=None, week=None, size=None):
+        self.id = id
+        self.updated_at = updated_at
+        # The issue of the item, which receives its comments
+        self.content_id = content_id
+        self.url = url
+        # YYYY-MM-DD
+        self.due_date = due_date
+        # The name of the Estimate option, the rules map it to a Size by name
+        self.estimate = estimate
+        # The ids of the Release and Size options and of the Week iteration
+        self.release = release
+        self.week = week
+        self.size = size
+
+    @classmethod
+    def from_node(cls, node):
+        """
+        Builds the record of an item node of the items query, see graphql.build_items_query.
+        """
+        content = node.get('content') or {}
+        return cls(
+            id=node['id'],
+            updated_at=node.get('updatedAt'),
+            content_id=content.get('id'),
+            url=content.get('url'),
+            due_date=_intern((node.get('dueDate') or {}).get('date')),
+            estimate=_intern((node.get('estimate') or {}).get('name')),
+            release=_intern((node.get('release') or {}).get('id')),
+            week=_intern((node.get('week') or {}).get('id')),
+            size=_intern((node.get('size') or {}).get('id')),
+        )
+
+    def __repr__(self):
+        return f"ProjectItem({self.id}, {self.url})"
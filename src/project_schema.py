@@ -0,0 +1,179 @@
+import json
+import os
+import threading
+import time
+
+import config
+import graphql
+import utils
+from logger import logger
+
+# Bump when the cached format changes, older cache files are then ignored
+CACHE_VERSION = 1
+
+
+class ProjectSchema:
+    """
+    Compiled view of the fields of a project, built once from the get_project response.
+
+    Fields and options are looked up by name, the weeks and releases are indexed in a
+    utils.CalendarIndex and the Size of every Estimate is memoized once an item uses it.
+    """
+
+    def __init__(self, project):
+        self.project = project
+        self.id = project['id']
+        self.updated_at = project.get('updatedAt')
+
+        # Field name -> field, the nodes of unsupported field types are empty
+        self.fields = {field['name']: field for field in project['fields']['nodes'] if field}
+        # Field name -> option name -> option
+        self.options = {
+            name: {option['name']: option for option in field['options']}
+            for name, field in self.fields.items() if 'options' in field
+        }
+
+        self.release_field = self.fields.get('Release')
+        self.week_field = self.fields.get('Week')
+        self.size_field = self.fields.get('Size')
+
+        self.release_options = self.release_field['options'] if self.release_field else []
+        self.week_options = (
+            self.week_field['configuration']['iterations'] + self.week_field['configuration']['completedIterations']
+            if self.week_field else []
+        )
+        self.size_options = self.size_field['options'] if self.size_field else []
+
+        self.calendar = utils.CalendarIndex(weeks=self.week_options, releases=self.release_options)
+
+        # Estimate name -> size option, filled by find_size for the estimates the items use
+        self.size_by_estimate = {}
+
+    def find_size(self, estimate_name):
+        if estimate_name not in self.size_by_estimate:
+            self.size_by_estimate[estimate_name] = utils.find_size(sizes=self.size_options, estimate_name=estimate_name)
+
+        return self.size_by_estimate[estimate_name]
+
+
+# (owner, project number) -> (ProjectSchema, time it was fetched), kept for the lifetime of the process
+_loaded = {}
+# (owner, project number) -> Future of the schema, for the loads started by preload
+_pending = {}
+_loaded_lock = threading.Lock()
+
+
+def cache_path(project_id):
+    return os.path.join(config.cache_dir, f"schema-{project_id}.json")
+
+
+def read_cache(project_id):
+    try:
+        with open(cache_path(project_id)) as cache_file:
+            cached = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+
+    if cached.get('version') != CACHE_VERSION:
+        return None
+
+    return cached
+
+
+def write_cache(project):
+    os.makedirs(config.cache_dir, exist_ok=True)
+    path = cache_path(project['id'])
+    # Write to a temporary file first, so a concurrent reader never sees half a file
+    with open(f"{path}.tmp", 'w') as cache_file:
+        json.dump({'version': CACHE_VERSION, 'fetched_at': time.time(), 'project': project}, cache_file)
+    os.replace(f"{path}.tmp", path)
+
+
+def load(owner, project_number, owner_type='organization'):
+    """
+    Returns the ProjectSchema of a project, from the local cache when it is still valid.
+
+    A cached schema is used when the project has not been updated since it was fetched and it is
+    younger than config.schema_cache_ttl seconds. Validating it costs a tiny query instead of the
+    full get_project one. A schema loaded earlier by the same process, such as a daemon, is reused
+    as is, without reading the cache file, and only rebuilds its calendar index once a new week has
+    started. A load started by preload is waited for.
+    """
+    with _loaded_lock:
+        pending = _pending.pop((owner, project_number), None)
+    if pending:
+        return pending.result()
+
+    return resolve(owner, project_number, owner_type)
+
+
+def resolve(owner, project_number, owner_type):
+    """
+    Returns the schema loaded earlier by the process while it is valid, or the one of fetch.
+    """
+    key = (owner, project_number)
+    with _loaded_lock:
+        loaded = _loaded.get(key)
+
+    stamp = None
+    if config.cache_dir or loaded:
+        stamp = graphql.get_project_stamp(owner, project_number, owner_type=owner_type)
+        if (
+            loaded
+            and loaded[0].updated_at == stamp['updatedAt']
+            and time.time() - loaded[1] < config.schema_cache_ttl
+        ):
+            if loaded[0].calendar.start_of_week == utils.week_start():
+                return loaded[0]
+
+            # A new week started since the calendar index was built, rebuild it from the same fields
+            schema = ProjectSchema(loaded[0].project)
+            with _loaded_lock:
+                _loaded[key] = (schema, loaded[1])
+            return schema
+
+    schema, fetched_at = fetch(owner, project_number, owner_type, stamp if config.cache_dir else None)
+    with _loaded_lock:
+        _loaded[key] = (schema, fetched_at)
+
+    return schema
+
+
+def preload(owner, project_number, owner_type='organization'):
+    """
+    Starts loading the schema of a project in the background, the next load of the project then
+    waits for it instead of sending its own requests.
+    """
+    key = (owner, project_number)
+    with _loaded_lock:
+        if key not in _pending:
+            _pending[key] = utils.background(resolve, owner, project_number, owner_type)
+
+
+def fetch(owner, project_number, owner_type, stamp=None):
+    """
+    Builds the ProjectSchema of a project from the cache file when it matches the stamp, or from a
+    get_project query.
+
+    :return: A (ProjectSchema, time the project was fetched) tuple.
+    """
+    if stamp:
+        cached = read_cache(stamp['id'])
+        if (
+            cached
+            and cached['project'].get('updatedAt') == stamp['updatedAt']
+            and time.time() - cached['fetched_at'] < config.schema_cache_ttl
+        ):
+            logger.info(f"Using the cached schema of project {stamp['id']}")
+            return ProjectSchema(cached['project']), cached['fetched_at']
+
+    fetched_at = time.time()
+    project = graphql.get_project(owner, project_number, owner_type=owner_type)
+
+    if config.cache_dir:
+        try:
+            write_cache(project)
+        except OSError as e:
+            logger.info(f"Could not cache the project schema: {e}")
+
+    return ProjectSchema(project), fetched_at
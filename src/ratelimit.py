@@ -0,0 +1,86 @@
+import threading
+import time
+
+import deadline
+from logger import logger
+
+
+class RateLimiter:
+    """
+    Paces requests according to the rate limit information GitHub sends back.
+
+    The primary limit is read from the X-RateLimit-Remaining and X-RateLimit-Reset headers: once the
+    remaining points drop to min_remaining, requests wait for the reset. Retry-After pauses every
+    request for the given time. Content-creating requests (comments) are additionally spaced by
+    content_interval seconds per created item to stay under the secondary rate limits.
+    """
+
+    def __init__(self, min_remaining, content_interval):
+        self.min_remaining = min_remaining
+        self.content_interval = content_interval
+        self.lock = threading.Lock()
+        self.remaining = None
+        self.reset_at = 0
+        self.blocked_until = 0
+        self.next_content_at = 0
+
+    def wait(self, content_created=0):
+        """
+        Blocks until the next request may be sent.
+
+        :param content_created: Number of comments or other contents the request creates.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self._available_at(now))
+
+            if content_created:
+                # Reserve a slot, so concurrent callers queue up behind each other
+                start = max(start, self.next_content_at)
+                self.next_content_at = start + self.content_interval * content_created
+
+        delay = start - now
+        if delay > 0:
+            # Stop cleanly instead of sleeping through the end of the run, e.g. until an hourly reset
+            deadline.check(start)
+            if delay > 5:
+                logger.info(f"Rate limit reached, waiting {delay:.0f}s")
+            time.sleep(delay)
+
+    def _available_at(self, now):
+        available_at = self.blocked_until
+        if self.remaining is not None and self.remaining <= self.min_remaining and self.reset_at > now:
+            available_at = max(available_at, self.reset_at)
+        return available_at
+
+    def available_at(self):
+        """
+        Returns the time from which requests may be sent again, in the past when they may be sent now.
+        """
+        with self.lock:
+            return self._available_at(time.time())
+
+    def observe(self, response):
+        """
+        Updates the limits from the headers of a response.
+        """
+        headers = response.headers
+        with self.lock:
+            if headers.get('X-RateLimit-Remaining') is not None:
+                self.remaining = int(headers['X-RateLimit-Remaining'])
+            if headers.get('X-RateLimit-Reset') is not None:
+                self.reset_at = int(headers['X-RateLimit-Reset'])
+            if headers.get('Retry-After'):
+                self.blocked_until = max(self.blocked_until, time.time() + float(headers['Retry-After']))
+
+    def is_exhausted(self, response):
+        """
+        Detects responses rejected because the primary rate limit was used up.
+        """
+        if response.headers.get('X-RateLimit-Remaining') != '0':
+            return False
+        if response.status_code in (403, 429):
+            return True
+        # The GraphQL API answers with 200 and a RATE_LIMITED error
+        return response.status_code == 200 and b'RATE_LIMITED' in response.content
+
@@ -0,0 +1,18 @@
+import zlib
+
+import config
+
+
+def shard_of(item_id, shard_count):
+    """
+    Assigns an item to a shard by a stable hash of its id, the same in every job and every run.
+    """
+    return zlib.crc32(item_id.encode()) % shard_count
+
+
+def suffix():
+    """
+    Distinguishes the files kept in cache_dir by each shard, so that shards sharing a cache do not
+    overwrite each other's state.
+    """
+    return f"-shard{config.shard_index}of{config.shard_count}" if config.shard_count > 1 else ''
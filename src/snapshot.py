@@ -0,0 +1,77 @@
+import gzip
+import json
+import time
+
+from logger import logger
+from project_item import ProjectItem
+from project_schema import ProjectSchema
+
+# Bump when the snapshot format changes, older snapshots are then rejected
+SNAPSHOT_VERSION = 1
+
+# Items per page when reading a snapshot back
+PAGE_SIZE = 1000
+
+
+class SnapshotWriter:
+    """
+    Writes projects and their items to a gzipped JSON lines snapshot.
+
+    Every project starts with an object line holding its get_project data, followed by one array
+    line per item with the ProjectItem attributes in slot order.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wt', compresslevel=6)
+        self.items = 0
+
+    def add_project(self, owner, project_number, schema):
+        self.file.write(json.dumps({
+            'version': SNAPSHOT_VERSION,
+            'owner': owner,
+            'project_number': project_number,
+            'exported_at': int(time.time()),
+            'project': schema.project,
+        }) + '\n')
+
+    def add_items(self, items):
+        for item in items:
+            self.file.write(json.dumps([getattr(item, slot) for slot in ProjectItem.__slots__]) + '\n')
+        self.items += len(items)
+
+    def close(self):
+        self.file.close()
+        logger.info(f"Snapshot written to {self.path}: {self.items} items")
+
+
+def read(path):
+    """
+    Reads a snapshot back, without any request.
+
+    :return: An iterator of (owner, project number, ProjectSchema, pages) tuples, where pages is a
+             list of lists of ProjectItem records.
+    """
+    with gzip.open(path, 'rt') as snapshot_file:
+        header = None
+        items = []
+        for line in snapshot_file:
+            row = json.loads(line)
+            if isinstance(row, list):
+                items.append(ProjectItem(*row))
+                continue
+
+            if header:
+                yield project_entry(header, items)
+            if row.get('version') != SNAPSHOT_VERSION:
+                raise ValueError(f"Unsupported snapshot version {row.get('version')} in {path}")
+            header = row
+            items = []
+
+        if header:
+            yield project_entry(header, items)
+
+
+def project_entry(header, items):
+    pages = [items[start:start + PAGE_SIZE] for start in range(0, len(items), PAGE_SIZE)]
+    return header['owner'], header['project_number'], ProjectSchema(header['project']), pages
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from datetime import datetime, timedelta, timezone
+
+import config
+import sharding
+from logger import logger
+
+
+def item_values(item):
+    """
+    Extracts the field values the rules read and write from a project_item.ProjectItem.
+    """
+    return {
+        'dueDate': item.due_date,
+        'estimate': item.estimate,
+        'release': item.release,
+        'week': item.week,
+        'size': item.size,
+    }
+
+
+def apply_updates(values, schema, updates):
+    """
+    Returns the field values of an item once the given updates have been applied.
+    """
+    aliases = {
+        field['id']: alias
+        for alias, field in (('release', schema.release_field), ('week', schema.week_field), ('size', schema.size_field))
+        if field
+    }
+    values = dict(values)
+    for update in updates:
+        if update['field_id'] in aliases:
+            values[aliases[update['field_id']]] = update['value']
+
+    return values
+
+
+def schema_context(schema):
+    """
+    Fingerprints everything besides the item itself that the rule results depend on: the project
+    fields and the current week. Stored results are only reused while it stays the same.
+    """
+    fields = json.dumps(schema.project['fields'], sort_keys=True)
+    digest = hashlib.sha256(fields.encode()).hexdigest()
+    return f"{digest}:{schema.calendar.start_of_week.isoformat()}"
+
+
+class StateStore:
+    """
+    SQLite store of the items seen by previous runs, used by the incremental sync mode.
+
+    For every item it keeps the updatedAt timestamp and the field values last seen or written. An
+    item whose values are unchanged since then yields the same rule results, so it can be skipped.
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS items (
+                project_id TEXT NOT NULL,
+                item_id TEXT NOT NULL,
+                updated_at TEXT,
+                item_values TEXT NOT NULL,
+                PRIMARY KEY (project_id, item_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        """)
+
+    def get_meta(self, key):
+        row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key, value):
+        self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def begin(self, project_id, context):
+        """
+        Decides between an incremental and a full sync of a project.
+
+        A full sync runs when the project fields or the current week changed, or the last full sync
+        is older than config.full_resync_interval seconds. It evaluates every item again, so the
+        results stored for the project are dropped, which is committed along with the sync by finish.
+
+        :return: The date of the last successful sync for an incremental sync, None for a full sync.
+        """
+        last_full_sync = float(self.get_meta(f"last_full_sync:{project_id}") or 0)
+        if (
+            self.get_meta(f"context:{project_id}") != context
+            or time.time() - last_full_sync >= config.full_resync_interval
+        ):
+            logger.info('Running a full sync')
+            self.connection.execute("DELETE FROM items WHERE project_id = ?", (project_id,))
+            return None
+
+        last_sync = self.get_meta(f"last_sync:{project_id}")
+        logger.info(f"Running an incremental sync of the items changed since {last_sync}")
+        return last_sync
+
+    def is_unchanged(self, project_id, item):
+        row = self.connection.execute(
+            "SELECT updated_at, item_values FROM items WHERE project_id = ? AND item_id = ?",
+            (project_id, item.id)
+        ).fetchone()
+        if not row:
+            return False
+
+        updated_at, values = row
+        if updated_at is not None and updated_at == item.updated_at:
+            return True
+        return json.loads(values) == item_values(item)
+
+    def record(self, project_id, item, values):
+        self.connection.execute(
+            "INSERT OR REPLACE INTO items (project_id, item_id, updated_at, item_values) VALUES (?, ?, ?, ?)",
+            (project_id, item.id, item.updated_at, json.dumps(values, sort_keys=True))
+        )
+
+    def forget(self, project_id, item_ids):
+        self.connection.executemany(
+            "DELETE FROM items WHERE project_id = ? AND item_id = ?",
+            [(project_id, item_id) for item_id in item_ids]
+        )
+
+    def finish(self, project_id, context, started_at, full):
+        """
+        Marks a sync as successful and commits everything recorded during it.
+
+        :param started_at: The time the sync started, items changed after it are fetched next time.
+        """
+        # Project searches filter by day, start a day early so that time zones cannot hide an item
+        since = datetime.fromtimestamp(started_at, timezone.utc).date() - timedelta(days=1)
+        self.set_meta(f"last_sync:{project_id}", since.isoformat())
+        self.set_meta(f"context:{project_id}", context)
+        if full:
+            self.set_meta(f"last_full_sync:{project_id}", started_at)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+
+def open_store(project_id):
+    # One database per project, so that concurrently processed projects do not lock each other
+    os.makedirs(config.cache_dir, exist_ok=True)
+    return StateStore(os.path.join(config.cache_dir, f"state-{project_id}{sharding.suffix()}.sqlite"))
@@ -0,0 +1,208 @@
+import json
+import random
+import re
+import time
+
+import config
+import credentials
+import deadline
+from metrics import metrics
+from logger import logger
+
+try:
+    # Optional, decodes large item pages several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
+
+# HTTP status codes that are worth another attempt
+RETRYABLE_STATUS_CODES = {500, 502, 503, 504}
+
+_session = None
+
+
+def get_session():
+    """
+    Returns the shared session, creating it on first use.
+
+    The session keeps a pool of persistent connections to the API endpoint, so every request after
+    the first one skips the TCP and TLS handshakes. The authorization is set per request, by the
+    credential it is sent with.
+    """
+    # Imported on first use, runs that send no request, such as a snapshot evaluation, start faster
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    global _session
+    if _session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=config.http_pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({
+            "Content-Type": "application/json",
+            "Accept-Encoding": "gzip",
+        })
+        _session = session
+
+    return _session
+
+
+def is_abuse_limited(response):
+    """
+    Detects GitHub's secondary ("abuse") rate limit responses.
+    """
+    if response.status_code not in (403, 429):
+        return False
+    if response.headers.get('Retry-After'):
+        return True
+    text = response.text.lower()
+    return 'secondary rate limit' in text or 'abuse' in text
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    delay = min(config.http_backoff_max, config.http_backoff * (2 ** attempt))
+    return random.uniform(0, delay)
+
+
+def never_sent(error):
+    """
+    Tells whether a failed request cannot have reached the server, because no connection was made.
+    """
+    import requests
+    from urllib3.exceptions import NewConnectionError
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def dumps(value):
+    return orjson.dumps(value) if orjson else json.dumps(value).encode()
+
+
+def loads(content):
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def operation_name(query):
+    match = re.search(r'\b(query|mutation)\s+(\w+)', query)
+    return match.group(2) if match else 'anonymous'
+
+
+def post(query, variables=None, content_created=0, retry_server_errors=True):
+    """
+    Sends a GraphQL document, retrying on transient failures.
+
+    Connection errors, timeouts and 5xx responses are retried with exponential backoff and jitter.
+    Requests creating content are the exception: GitHub often applies a mutation it answers with a
+    5xx or too late, so they are only retried when they cannot have reached it, and would otherwise
+    post their comments twice. Secondary rate limit responses wait for Retry-After when GitHub sends
+    it, and requests rejected by the primary rate limit wait for its reset. Every attempt goes out with the credential of the
+    pool with the most points left, so a request held back on one credential moves to another one.
+
+    :param content_created: Number of comments the request creates, used to pace content creation.
+    :param retry_server_errors: Whether 5xx responses are retried, callers that adapt the request to
+                                the failure, such as a smaller page, handle them themselves.
+    :return: The last requests.Response received.
+    """
+    import requests
+
+    if content_created:
+        retry_server_errors = False
+    session = get_session()
+    pool = credentials.get_pool()
+    operation = operation_name(query)
+    body = dumps({"query": query, "variables": variables or {}})
+    attempt = 0
+    while True:
+        credential = pool.acquire()
+        limiter = credential.limiter
+        try:
+            authorization = credential.authorization(session)
+        except (requests.RequestException, ImportError, ValueError) as e:
+            # A GitHub App whose installation token cannot be created
+            if not pool.disable(credential, e):
+                raise
+            continue
+
+        limiter.wait(content_created)
+        started = time.perf_counter()
+        try:
+            response = session.post(
+                config.api_endpoint,
+                data=body,
+                headers={"Authorization": authorization},
+                timeout=(config.http_connect_timeout, config.http_read_timeout)
+            )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe_request(operation, time.perf_counter() - started, len(body), 0, error=True, retry=attempt > 0)
+            if attempt >= config.http_max_retries or (content_created and not never_sent(e)):
+                raise
+            delay = backoff_delay(attempt)
+            logger.info(f"Request failed ({e}), retrying in {delay:.1f}s")
+        else:
+            # The transferred size, which is the compressed one for gzip responses
+            received = int(response.headers.get('Content-Length') or len(response.content))
+            metrics.observe_request(
+                operation, time.perf_counter() - started, len(body), received,
+                error=response.status_code != 200, retry=attempt > 0
+            )
+            limiter.observe(response)
+            if pool.remaining() is not None:
+                metrics.observe_rate_limit(pool.remaining())
+            if response.status_code in RETRYABLE_STATUS_CODES and retry_server_errors:
+                delay = backoff_delay(attempt)
+            elif limiter.is_exhausted(response):
+                # The limiter holds the credential until its rate limit resets, another one may go on
+                delay = 0
+            elif response.status_code in RETRYABLE_STATUS_CODES:
+                return response
+            elif response.status_code == 401 and len(pool.credentials) > 1:
+                # A revoked or expired token, the other credentials carry on
+                if not pool.disable(credential, f"HTTP {response.status_code}"):
+                    return response
+                delay = 0
+            elif is_abuse_limited(response):
+                # With Retry-After, the limiter holds the credential for that long
+                delay = 0 if response.headers.get('Retry-After') else backoff_delay(attempt)
+            else:
+                return response
+
+            if attempt >= config.http_max_retries:
+                return response
+            logger.info(f"HTTP error {response.status_code}, retrying in {delay:.1f}s")
+
+        if delay > 0:
+            deadline.check(time.time() + delay)
+            time.sleep(delay)
+        attempt += 1
+
+
+def execute(query, variables=None, content_created=0, retry_server_errors=True):
+    """
+    Sends a GraphQL document and returns the decoded response body.
+
+    HTTP failures are reported the same way as GraphQL failures, as a body with an 'errors' list, and
+    so are the failed requests creating content, which are not retried, see post. The body is decoded
+    once, straight from the raw bytes.
+    """
+    import requests
+
+    try:
+        response = post(query, variables, content_created, retry_server_errors)
+    except (requests.ConnectionError, requests.Timeout) as e:
+        if not content_created:
+            raise
+        metrics.observe_error(operation_name(query))
+        return {"errors": [{"message": f"Request failed: {e}"}]}
+    if response.status_code != 200:
+        return {"errors": [{"message": f"HTTP error {response.status_code}: {response.text}"}]}
+
+    data = loads(response.content)
+    if data.get('errors'):
+        metrics.observe_error(operation_name(query))
+
+    return data
@@ -1,128 +1,330 @@
+import bisect
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta
+from queue import Full, Queue
+
 from logger import logger
+from metrics import metrics
 
 
-def find_week(weeks, date_str):
-    # Parse the input date
-    target_date = datetime.strptime(date_str, '%Y-%m-%d')
+class Prefetcher:
+    """
+    Iterates over the values of an iterable consumed in a background thread, see prefetch.
 
-    # Get today's date
-    today = datetime.today()
+    The consumer must close it when it stops early, the producer then stops fetching values, closes
+    the iterable and exits instead of waiting forever for room in the queue.
+    """
 
-    # Calculate the start of the current week (Monday by default)
-    start_of_week = datetime(today.year, today.month, today.day) - timedelta(days=today.weekday())
-    start_of_week = start_of_week.replace(hour=0, minute=0, second=0, microsecond=0)
+    # Seconds between the checks for close while the queue is full
+    POLL_INTERVAL = 0.1
 
-    # Calculate the end of the current week
-    end_of_week = start_of_week + timedelta(days=6, hours=23, minutes=59, seconds=59)
+    def __init__(self, iterable, size=1):
+        self.queue = Queue(maxsize=size)
+        self.stopped = threading.Event()
+        self.done = False
+        threading.Thread(target=self._produce, args=(iterable,), daemon=True).start()
 
-    # Check if the target date is within the current week
-    if start_of_week <= target_date <= end_of_week:
-        for week in weeks:
-            # Parse the start date of the week
-            start_date = datetime.strptime(week['startDate'], '%Y-%m-%d')
-            # Calculate the end date based on the duration
-            end_date = start_date + timedelta(days=week['duration'] - 1)
+    def _produce(self, iterable):
+        try:
+            for value in iterable:
+                if not self._put((value, None)) or self.stopped.is_set():
+                    return
+        except Exception as e:
+            self._put((self, e))
+        else:
+            self._put((self, None))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
 
-            # Check if the target date falls within this week
-            if start_date <= target_date <= end_date:
-                return week  # Return the matching week dictionary
+    def _put(self, entry):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(entry, timeout=self.POLL_INTERVAL)
+                return True
+            except Full:
+                pass
+        return False
 
-        return None  # Return None if no matching week is found
-    else:
-        return find_previous_week(weeks, date_str)
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.done:
+            raise StopIteration
 
+        # The end of the values is marked by the prefetcher itself, with the error of the iterable
+        value, error = self.queue.get()
+        if value is self:
+            self.done = True
+            if error:
+                raise error
+            raise StopIteration
+        return value
 
-def find_previous_week(weeks, date_str):
-    # Parse the input date
-    target_date = datetime.strptime(date_str, '%Y-%m-%d')
+    def close(self):
+        self.done = True
+        self.stopped.set()
 
-    # Sort the weeks by their startDate
-    sorted_weeks = sorted(weeks, key=lambda week: datetime.strptime(week['startDate'], '%Y-%m-%d'))
 
-    previous_week = None
-    for i, week in enumerate(sorted_weeks):
-        week_start_date = datetime.strptime(week['startDate'], '%Y-%m-%d')
-        week_end_date = week_start_date + timedelta(days=week['duration'] - 1)
+def prefetch(iterable, size=1):
+    """
+    Consumes an iterable in a background thread, keeping up to `size` values ready for the consumer.
 
-        # If the current week includes the target date or is in the future, pick the previous week
-        if week_start_date <= target_date <= week_end_date or week_start_date > target_date:
-            if i > 0:
-                previous_week = sorted_weeks[i - 1]
-            break
+    Used to fetch the next page of items while the current one is being processed. Exceptions raised
+    by the iterable are re-raised in the consumer.
 
-    return previous_week
+    :return: A Prefetcher, to be closed by a consumer stopping before the end.
+    """
+    return Prefetcher(iterable, size)
 
 
-def find_release(releases, date_str):
-    from datetime import datetime
+def background(function, *args, **kwargs):
+    """
+    Calls a function in a background thread.
 
-    # Parse the input date
-    target_date = datetime.strptime(date_str, '%Y-%m-%d')
+    Used to send the independent requests of the startup concurrently.
 
-    for release in releases:
+    :return: A concurrent.futures.Future of the result, whose result() re-raises the exceptions of the call.
+    """
+    future = Future()
+
+    def call():
         try:
-            # Extract the date range from the release name
-            date_range = release['name'].split('(')[0].strip()  # Get the part before the version
-            if ' - ' in date_range:
-                start_date_str, end_date_str = date_range.split(' - ')
-                # Append the year from the end_date for parsing
-                if ',' not in end_date_str:
-                    end_date_str += f", {target_date.year}"
-                end_date = datetime.strptime(end_date_str.strip(), '%b %d, %Y')
-
-                # Determine the year for the start_date
-                if ',' not in start_date_str:
-                    # Parse start_date with the same year as end_date by default
-                    start_date = datetime.strptime(start_date_str.strip() + f", {end_date.year}", '%b %d, %Y')
-
-                    # Adjust the year if the start month is greater than the end month
-                    if start_date.month > end_date.month:
-                        start_date = start_date.replace(year=end_date.year - 1)
-                else:
-                    start_date = datetime.strptime(start_date_str.strip(), '%b %d, %Y')
-
-                # Debugging output for validation
-                logger.debug(f"Release: {release['name']}, Start: {start_date}, End: {end_date}")
-
-                # Check if the target date falls within this release period
-                if start_date <= target_date <= end_date:
-                    return release  # Return the matching release dictionary
+            future.set_result(function(*args, **kwargs))
         except Exception as e:
-            # Log parsing issues for debugging
-            logger.error(f"Error parsing release: {release['name']}, Error: {e}")
-            continue
+            future.set_exception(e)
 
-    return None  # Return None if no matching release is found
+    threading.Thread(target=call, daemon=True).start()
+    return future
 
 
-def find_size(sizes, estimate_name):
-    # Define size thresholds dynamically from the size definitions
-    size_thresholds = {
-        'X-Large (1-4 weeks)': (168, float('inf')),  # >168 hours (1-4 weeks)
-        'Large (4+ -7 days)': (96, 168),  # 96-168 hours (4-7 days)
-        'Medium (2+ -4 days)': (48, 96),  # 48-96 hours (2-4 days)
-        'Small (1-2 days)': (24, 48),  # 24-48 hours (1-2 days)
-        'Tiny (< 1 day, 1-6 hours)': (0, 24)  # <24 hours (Tiny)
-    }
+# GitHub rejects comment bodies longer than 65536 characters, keep some room for the header
+COMMENT_MAX_LENGTH = 65000
+
+
+def split_digest(summaries, header, max_length=COMMENT_MAX_LENGTH):
+    """
+    Packs per item summaries into as few comment bodies as possible.
+
+    :param summaries: The summaries, each one is kept whole unless it alone exceeds max_length.
+    :param header: The first line of every comment, followed by the part number when there are several.
+    :return: A list of comment bodies.
+    """
+    separator = "\n\n"
+    chunks = []
+    current = []
+    length = 0
+    for summary in summaries:
+        summary = summary[:max_length]
+        if current and length + len(separator) + len(summary) > max_length:
+            chunks.append(current)
+            current = []
+            length = 0
+        length += (len(separator) if current else 0) + len(summary)
+        current.append(summary)
+    if current:
+        chunks.append(current)
+
+    bodies = []
+    for index, chunk in enumerate(chunks):
+        title = header if len(chunks) == 1 else f"{header} ({index + 1}/{len(chunks)})"
+        bodies.append(title + separator + separator.join(chunk))
+
+    return bodies
+
 
+# Size name -> (lower, upper] bounds of the estimate in hours
+SIZE_THRESHOLDS = {
+    'X-Large (1-4 weeks)': (168, float('inf')),  # >168 hours (1-4 weeks)
+    'Large (4+ -7 days)': (96, 168),  # 96-168 hours (4-7 days)
+    'Medium (2+ -4 days)': (48, 96),  # 48-96 hours (2-4 days)
+    'Small (1-2 days)': (24, 48),  # 24-48 hours (1-2 days)
+    'Tiny (< 1 day, 1-6 hours)': (0, 24)  # <24 hours (Tiny)
+}
+
+
+def estimate_hours(estimate_name):
     # Convert the estimate to comparable hours
     if 'week' in estimate_name:
-        value = float(estimate_name.split()[0]) * 7 * 24  # weeks to hours
+        return float(estimate_name.split()[0]) * 7 * 24  # weeks to hours
     elif 'day' in estimate_name:
-        value = float(estimate_name.split()[0]) * 24  # days to hours
+        return float(estimate_name.split()[0]) * 24  # days to hours
     elif 'hour' in estimate_name:
-        value = float(estimate_name.split()[0])  # hours
+        return float(estimate_name.split()[0])  # hours
     elif 'min' in estimate_name:
-        value = float(estimate_name.split()[0]) / 60  # minutes to hours
-    else:
-        value = 0
+        return float(estimate_name.split()[0]) / 60  # minutes to hours
+
+    return 0
+
+
+def find_size(sizes, estimate_name):
+    value = estimate_hours(estimate_name)
 
     # Find the matching size based on thresholds
     for size in sizes:
         size_name = size['name']
-        lower, upper = size_thresholds.get(size_name, (None, None))
+        lower, upper = SIZE_THRESHOLDS.get(size_name, (None, None))
         if lower is not None and lower < value <= upper:
             return size  # Return the matching size definition
 
     return None  # Return None if no match found
+
+
+def parse_release_dates(name, year):
+    """
+    Parses the date range of a release name such as "Jan 6 - Jan 19 (v1.2)".
+
+    :param year: The year used when the end date does not specify one.
+    :return: A (start_date, end_date) tuple, or None if the name holds no date range.
+    """
+    # Get the part before the version
+    date_range = name.split('(')[0].strip()
+    if ' - ' not in date_range:
+        return None
+
+    start_date_str, end_date_str = date_range.split(' - ')
+    # Append the year for parsing
+    if ',' not in end_date_str:
+        end_date_str += f", {year}"
+    end_date = datetime.strptime(end_date_str.strip(), '%b %d, %Y')
+
+    # Determine the year for the start_date
+    if ',' not in start_date_str:
+        # Parse start_date with the same year as end_date by default
+        start_date = datetime.strptime(start_date_str.strip() + f", {end_date.year}", '%b %d, %Y')
+
+        # Adjust the year if the start month is greater than the end month
+        if start_date.month > end_date.month:
+            start_date = start_date.replace(year=end_date.year - 1)
+    else:
+        start_date = datetime.strptime(start_date_str.strip(), '%b %d, %Y')
+
+    return start_date, end_date
+
+
+def week_start(today=None):
+    """
+    Returns the date of the Monday of the current week.
+    """
+    today = (today or datetime.today()).date()
+    return today - timedelta(days=today.weekday())
+
+
+class CalendarIndex:
+    """
+    Resolves due dates to weeks and releases.
+
+    A date in the current week resolves to the iteration containing it, any other date to the
+    iteration before the first one that ends on or after it. A date resolves to the release whose
+    range contains it, the first one in option order when ranges overlap.
+
+    The iterations and release names are parsed once into interval arrays sorted by start date, which
+    are searched with bisect. Results are memoized per due date, since many items share one.
+    """
+
+    def __init__(self, weeks, releases, today=None):
+        # Calculate the current week (Monday to Sunday)
+        self.start_of_week = week_start(today)
+        self.end_of_week = self.start_of_week + timedelta(days=6)
+
+        intervals = []
+        for week in weeks:
+            start_date = datetime.strptime(week['startDate'], '%Y-%m-%d').date()
+            intervals.append((start_date, start_date + timedelta(days=week['duration'] - 1), week))
+        intervals.sort(key=lambda interval: interval[0])
+
+        # Iterations never overlap, so both the start and the end dates are sorted
+        self.week_starts = [interval[0] for interval in intervals]
+        self.week_ends = [interval[1] for interval in intervals]
+        self.weeks = [interval[2] for interval in intervals]
+
+        self.releases = releases
+        # year -> release intervals, see _release_intervals
+        self.release_intervals = {}
+
+        self.week_memo = {}
+        self.release_memo = {}
+
+    def find_week(self, date_str):
+        if date_str not in self.week_memo:
+            self.week_memo[date_str] = self._find_week(datetime.strptime(date_str, '%Y-%m-%d').date())
+
+        return self.week_memo[date_str]
+
+    def _find_week(self, target_date):
+        if self.start_of_week <= target_date <= self.end_of_week:
+            # The week containing the target date
+            index = bisect.bisect_right(self.week_starts, target_date) - 1
+            if index >= 0 and target_date <= self.week_ends[index]:
+                return self.weeks[index]
+            return None
+
+        # The week before the first week that contains the target date or starts after it
+        index = bisect.bisect_left(self.week_ends, target_date)
+        if 0 < index < len(self.weeks):
+            return self.weeks[index - 1]
+        return None
+
+    def find_release(self, date_str):
+        if date_str not in self.release_memo:
+            self.release_memo[date_str] = self._find_release(datetime.strptime(date_str, '%Y-%m-%d'))
+
+        return self.release_memo[date_str]
+
+    def _find_release(self, target_date):
+        starts, ends, releases, overlapping = self._release_intervals(target_date.year)
+
+        if overlapping:
+            # Keep the first matching release in option order
+            for start_date, end_date, release in zip(starts, ends, releases):
+                if start_date <= target_date <= end_date:
+                    return release
+            return None
+
+        index = bisect.bisect_right(starts, target_date) - 1
+        if index >= 0 and target_date <= ends[index]:
+            return releases[index]
+        return None
+
+    def _release_intervals(self, year):
+        """
+        Parses the release names for target dates in the given year, since names without a year
+        take it from the target date.
+
+        :return: A (starts, ends, releases, overlapping) tuple. Without overlaps the intervals are
+                 sorted by start date, otherwise they are kept in option order.
+        """
+        if year in self.release_intervals:
+            return self.release_intervals[year]
+
+        started = time.perf_counter()
+
+        intervals = []
+        for release in self.releases:
+            try:
+                dates = parse_release_dates(release['name'], year)
+            except Exception as e:
+                # Log parsing issues for debugging
+                logger.error(f"Error parsing release: {release['name']}, Error: {e}")
+                continue
+            if dates:
+                intervals.append((dates[0], dates[1], release))
+
+        sorted_intervals = sorted(intervals, key=lambda interval: interval[0])
+        overlapping = any(
+            previous[1] >= current[0] for previous, current in zip(sorted_intervals, sorted_intervals[1:])
+        )
+        if not overlapping:
+            intervals = sorted_intervals
+
+        self.release_intervals[year] = (
+            [interval[0] for interval in intervals],
+            [interval[1] for interval in intervals],
+            [interval[2] for interval in intervals],
+            overlapping,
+        )
+        metrics.observe_phase('release_parsing', time.perf_counter() - started)
+        return self.release_intervals[year]